@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+#
+# Synthetic Mixpanel export generator for benchmarks.
+# Writes NDJSON in the export API's layout plus the Contact list the Salesforce stub should know.
+#
+
+import argparse, datetime, json, random
+
+
+REPORTS = ['Workers Compensation Trends', 'Core Systems Overview', 'Claims Benchmark', 'Policy Admin Vendors']
+
+
+def generate(path, events=10000, users=1000, event_names=('Report Preview Clicked', 'Page Viewed'),
+             duplicate_rate=0.2, invalid_rate=0.05, contact_rate=0.8, start=1426700000, seed=0, tracked=None):
+    '''
+    Writes `events` export lines to path and returns ({email: contact id} for users with a Contact,
+    number of distinct (contact, day, event, report) tasks a sync of the `tracked` event names,
+    default all, should create).
+    duplicate_rate of events repeat an earlier event's user, report and day;
+    invalid_rate of users have a distinct_id that is not an email.
+    '''
+    rng = random.Random(seed)
+    emails = ['user%d@example.com' % i if rng.random() >= invalid_rate else 'anonymous-%d' % i
+              for i in range(users)]
+    contacts = dict((email, '003%015d' % i) for i, email in enumerate(emails)
+                    if '@' in email and rng.random() < contact_rate)
+
+    seen, tasks, t = [], set(), start
+    with open(path, 'w') as f:
+        for i in range(events):
+            t += rng.randint(0, 3)
+            if seen and rng.random() < duplicate_rate:
+                name, email, report = rng.choice(seen)
+            else:
+                name, email, report = rng.choice(event_names), rng.choice(emails), rng.choice(REPORTS)
+                seen.append((name, email, report))
+            event = {'event': name, 'properties': {'time': t, 'distinct_id': email, 'Report Name': report,
+                                                   'mp_country_code': 'US', 'mp_lib': 'web'}}
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+            if email in contacts and (tracked is None or name in tracked):
+                #Task dates are local days, as SalesforceApi writes them
+                tasks.add((email, datetime.datetime.fromtimestamp(t).date(), name, report))
+    return contacts, len(tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic Mixpanel export')
+    parser.add_argument('path')
+    parser.add_argument('-events', type=int, default=10000)
+    parser.add_argument('-users', type=int, default=1000)
+    parser.add_argument('-duplicate_rate', type=float, default=0.2)
+    parser.add_argument('-invalid_rate', type=float, default=0.05)
+    parser.add_argument('-contact_rate', type=float, default=0.8)
+    parser.add_argument('-seed', type=int, default=0)
+    args = parser.parse_args()
+    contacts, tasks = generate(args.path, args.events, args.users, duplicate_rate=args.duplicate_rate,
+                        invalid_rate=args.invalid_rate, contact_rate=args.contact_rate, seed=args.seed)
+    with open(args.path + '.contacts.json', 'w') as f:
+        json.dump(contacts, f)
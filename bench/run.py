@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+#
+# Offline end-to-end benchmark of main.py's flow: a synthetic export is read through
+# Mixpanel.load_file and synced against the local Salesforce stub.
+#
+#   python -m bench.run -events 20000 -users 2000 -latency 0.02 -out after.json -baseline before.json
+#
+
+import argparse, json, logging, os, resource, tempfile, time
+
+from src.mixpanel_api import Mixpanel
+from src.salesforce_mp_zap import SalesforceApi
+from src.pipeline import sync
+
+from bench.generate import generate
+from bench.sfdc_stub import SalesforceStub, PlainHTTPAdapter
+
+
+EVENTS = ['Report Preview Clicked']
+
+
+class StubSalesforceApi(SalesforceApi):
+
+    '''SalesforceApi whose session talks to a SalesforceStub'''
+
+    def _login(self, **kwargs):
+        SalesforceApi._login(self, **kwargs)
+        self.request.mount('https://' + self.sf_instance, PlainHTTPAdapter())
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run(export_path, contacts, latency=0.0, workers=1, batch_size=200, api_rate=1000, api_burst=1000):
+    '''Syncs export_path against a fresh stub and returns the report dict'''
+    stub = SalesforceStub(contacts, latency=latency).start()
+    try:
+        salesforce_api = StubSalesforceApi(session_id='bench', instance=stub.instance,
+            assigned_to='Bench Owner', subject_components=['Report Name'], task_status='Completed',
+            api_rate=api_rate, api_burst=api_burst)
+        mixpanel = Mixpanel('bench', 'bench')
+        mixpanel.load_file(export_path)
+
+        started, latencies = {}, []
+        def timed(events):
+            for event in events:
+                started[id(event)] = time.time()
+                yield event
+
+        start = time.time()
+        events = timed(mixpanel.generate_salesforce_task_objects_by_event_type(EVENTS))
+        for event, added in sync(salesforce_api, events, workers, batch_size):
+            latencies.append(time.time() - started.pop(id(event)))
+        elapsed = time.time() - start
+    finally:
+        stub.shutdown()
+        stub.server_close()
+
+    calls = sum(stub.calls.values())
+    return {
+        'events': len(latencies),
+        'seconds': round(elapsed, 3),
+        'events_per_s': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'api_calls': calls,
+        'api_calls_per_event': round(float(calls) / len(latencies), 4) if latencies else None,
+        'api_calls_by_endpoint': dict(stub.calls),
+        'tasks_created': len(stub.tasks),
+        'throttled_s': round(salesforce_api.rate_limiter.throttled, 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'p50_latency_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_latency_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def compare(report, baseline):
+    '''{metric: report / baseline} for the numeric metrics both have'''
+    return dict((k, round(float(report[k]) / baseline[k], 3)) for k in report
+                if isinstance(report[k], (int, float)) and baseline.get(k))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Mixpanel -> Salesforce sync offline')
+    parser.add_argument('-export', help='Existing export file; needs <export>.contacts.json next to it')
+    parser.add_argument('-events', type=int, default=10000)
+    parser.add_argument('-users', type=int, default=1000)
+    parser.add_argument('-duplicate_rate', type=float, default=0.2)
+    parser.add_argument('-invalid_rate', type=float, default=0.05)
+    parser.add_argument('-latency', type=float, default=0.0, help='Seconds added to every stub request')
+    parser.add_argument('-workers', type=int, default=1)
+    parser.add_argument('-api_rate', type=float, default=1000)
+    parser.add_argument('-out', help='Write the report as JSON here')
+    parser.add_argument('-baseline', help='Earlier -out report to compare against')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.export:
+        export_path = args.export
+        with open(export_path + '.contacts.json') as f:
+            contacts = json.load(f)
+    else:
+        fd, export_path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        contacts, expected_tasks = generate(export_path, args.events, args.users, event_names=EVENTS + ['Page Viewed'],
+                                            duplicate_rate=args.duplicate_rate, invalid_rate=args.invalid_rate,
+                                            tracked=EVENTS)
+
+    try:
+        report = run(export_path, contacts, latency=args.latency, workers=args.workers,
+                     api_rate=args.api_rate, api_burst=int(args.api_rate))
+    finally:
+        if not args.export:
+            os.remove(export_path)
+
+    if not args.export:
+        report['tasks_expected'] = expected_tasks
+    print json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print 'vs baseline:', json.dumps(compare(report, json.load(f)), indent=2, sort_keys=True)
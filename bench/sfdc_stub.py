@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+#
+# Local stand-in for the Salesforce REST endpoints the zap uses:
+# query/ (+ nextRecordsUrl paging), composite/sobjects and sobjects/Task/.
+# Every request sleeps `latency` seconds first and is counted by endpoint.
+#
+
+import BaseHTTPServer, SocketServer
+import collections, json, re, threading, time, urlparse
+
+from requests.adapters import HTTPAdapter
+
+
+VERSION_PATH = '/services/data/v42.0/'
+
+
+class PlainHTTPAdapter(HTTPAdapter):
+
+    '''Sends the https:// URLs simple_salesforce builds to the stub over plain HTTP'''
+
+    def send(self, request, **kwargs):
+        request.url = 'http://' + request.url[len('https://'):]
+        return HTTPAdapter.send(self, request, **kwargs)
+
+
+class SalesforceStub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, contacts, latency=0.0, page_size=2000, owner_id='005000000000001'):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.contacts = dict((email.lower(), contact_id) for email, contact_id in contacts.items())
+        self.latency, self.page_size, self.owner_id = latency, page_size, owner_id
+        self.tasks = []
+        self.calls = collections.Counter()
+        self.cursors = {}
+        self.lock = threading.Lock()
+
+    @property
+    def instance(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def records_for(self, soql):
+        values = [v.replace("\\'", "'") for v in re.findall(r"'((?:[^'\\]|\\.)*)'", soql)]
+        sobject = re.search(r'\bfrom\s+(\w+)', soql, re.I).group(1).lower()
+        if sobject == 'user':
+            return [{'Id': self.owner_id}]
+        if sobject == 'contact':
+            return [{'Id': self.contacts[v.lower()], 'Email': v} for v in values if v.lower() in self.contacts]
+        if sobject == 'task':
+            since = re.search(r'ActivityDate >= (\d{4}-\d{2}-\d{2})', soql)
+            with self.lock:
+                return [dict(t) for t in self.tasks if t['WhoId'] in values and
+                        (not since or t['ActivityDate'] >= since.group(1))]
+        return []
+
+    def page(self, records):
+        with self.lock:
+            cursor = 'c%d' % len(self.cursors)
+            self.cursors[cursor] = records[self.page_size:]
+        result = {'totalSize': len(records), 'done': len(records) <= self.page_size,
+                  'records': records[:self.page_size]}
+        if not result['done']:
+            result['nextRecordsUrl'] = VERSION_PATH + 'query/' + cursor
+        return result
+
+    def create(self, records):
+        with self.lock:
+            results = []
+            for record in records:
+                record = dict((k, v) for k, v in record.items() if k != 'attributes')
+                record['Id'] = '00T%015d' % len(self.tasks)
+                self.tasks.append(record)
+                results.append({'id': record['Id'], 'success': True, 'errors': []})
+            return results
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def count(self, endpoint):
+        with self.server.lock:
+            self.server.calls[endpoint] += 1
+        time.sleep(self.server.latency)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == VERSION_PATH + 'query/':
+            self.count('query')
+            soql = urlparse.parse_qs(url.query)['q'][0]
+            return self.reply(200, self.server.page(self.server.records_for(soql)))
+        if url.path.startswith(VERSION_PATH + 'query/'):
+            self.count('query_more')
+            with self.server.lock:
+                records = self.server.cursors.pop(url.path.rsplit('/', 1)[1])
+            return self.reply(200, self.server.page(records))
+        self.reply(404, [{'errorCode': 'NOT_FOUND', 'message': self.path}])
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))) or 'null')
+        if self.path == VERSION_PATH + 'composite/sobjects':
+            self.count('composite')
+            return self.reply(200, self.server.create(body['records']))
+        if self.path == VERSION_PATH + 'sobjects/Task/':
+            self.count('create')
+            return self.reply(201, self.server.create([body])[0])
+        self.reply(404, [{'errorCode': 'NOT_FOUND', 'message': self.path}])
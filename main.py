@@ -1,14 +1,27 @@
 #! /usr/bin/env python
 
-import datetime, sys, os
+import datetime, sys, os, itertools, time, json, signal, threading, argparse
 
-from src.mixpanel_api import Mixpanel
-from src.salesforce_mp_zap import SalesforceApi
+#Read on its own first: the gevent engine has to patch sockets before requests and
+#simple_salesforce are imported
+engine_parser = argparse.ArgumentParser(add_help=False)
 
-import logging, argparse
+engine_parser.add_argument('-engine', action='store', dest="engine", choices=['threads', 'gevent'], default='threads',
+                    help='Run -workers as threads, or as greenlets on one gevent loop (needs gevent; use hundreds of workers)')
 
+if engine_parser.parse_known_args()[0].engine == 'gevent':
+    from src import gevent_pipeline
+    gevent_pipeline.patch()
 
-arg_parser = argparse.ArgumentParser()
+#Only the light modules here: requests, simple_salesforce and sqlite3 are imported where used,
+#so a run with nothing to export exits without loading them
+from src.checkpoint import Checkpoint
+from src.stats import RunStats
+
+import logging
+
+
+arg_parser = argparse.ArgumentParser(parents=[engine_parser])
 
 
 arg_parser.add_argument('-token', action='store', dest='token',
@@ -40,8 +53,99 @@ arg_parser.add_argument('-dates', action='store', dest="dates", nargs='+', type=
 
 arg_parser.add_argument('-sandbox', action='store', dest="sandbox", type=bool)
 
+arg_parser.add_argument('-contact_cache_size', action='store', dest="contact_cache_size", type=int, default=100000,
+                    help='Emails whose Contact lookup is kept in memory (least recently used are dropped)')
+
+arg_parser.add_argument('-task_cache_size', action='store', dest="task_cache_size", type=int, default=20000,
+                    help='Contacts whose existing Task fingerprints are kept in memory for dedupe')
+
+arg_parser.add_argument('-checkpoint', action='store', dest="checkpoint",
+                    help='File keeping the last processed event; runs resume from it instead of -dates start')
+
+arg_parser.add_argument('-workers', action='store', dest="workers", type=int, default=1,
+                    help='Worker threads doing Salesforce lookups and task creation concurrently')
+
+arg_parser.add_argument('-coalesce', action='store_true', dest="coalesce",
+                    help='Create one task per user, day and subject instead of one per event')
+
+arg_parser.add_argument('-coalesce_counts', action='store_true', dest="coalesce_counts",
+                    help='With -coalesce, add the event count and first/last time to the task Description')
+
+arg_parser.add_argument('-export_file', action='store', dest="export_file",
+                    help='Replay a downloaded export file instead of calling the Mixpanel API')
+
+arg_parser.add_argument('-parse_processes', action='store', dest="parse_processes", type=int, default=1,
+                    help='Processes parsing -export_file in parallel (e.g. the number of cores)')
+
+arg_parser.add_argument('-event_store', action='store', dest="event_store",
+                    help='SQLite file keeping exported events for later runs')
+
+arg_parser.add_argument('-offline', action='store_true', dest="offline",
+                    help='Read events for the date window from -event_store instead of Mixpanel')
+
+arg_parser.add_argument('-shard_days', action='store', dest="shard_days", type=int,
+                    help='Split the export into shards of this many days, fetched concurrently')
+
+arg_parser.add_argument('-max_in_flight', action='store', dest="max_in_flight", type=int, default=4,
+                    help='Export shards downloaded at once')
+
+arg_parser.add_argument('-summary', action='store', dest="summary",
+                    help='Where to write the JSON run summary (default: mp2sfdc_summary.json in the log directory)')
+
+arg_parser.add_argument('-profile', action='store_true', dest="profile",
+                    help='Profile the run with cProfile (and tracemalloc when available) next to the summary')
+
+arg_parser.add_argument('-api_rate', action='store', dest="api_rate", type=float, default=20,
+                    help='Starting Salesforce API calls per second, raised or lowered from observed limit errors')
+
+arg_parser.add_argument('-lookup_cache', action='store_true', dest="lookup_cache",
+                    help='Keep email to Contact lookups in a SQLite cache in the log directory between runs')
+
+arg_parser.add_argument('-cache_ttl', action='store', dest="cache_ttl", type=float, default=168,
+                    help='Hours a cached Contact id stays valid')
+
+arg_parser.add_argument('-negative_cache_ttl', action='store', dest="negative_cache_ttl", type=float, default=24,
+                    help='Hours a cached "not found / invalid" verdict stays valid')
+
+arg_parser.add_argument('-clear_cache', action='store_true', dest="clear_cache",
+                    help='Invalidate the lookup cache before running')
+
+arg_parser.add_argument('-api_burst', action='store', dest="api_burst", type=int, default=20,
+                    help='Salesforce API calls allowed in a burst')
+
+arg_parser.add_argument('-api_max_rate', action='store', dest="api_max_rate", type=float,
+                    help='Ceiling for the adaptive Salesforce API rate (default: none)')
+
+arg_parser.add_argument('-api_max_in_flight', action='store', dest="api_max_in_flight", type=int, default=64,
+                    help='Most Salesforce calls in flight at once; halved on limit errors')
+
+arg_parser.add_argument('-max_retries', action='store', dest="max_retries", type=int, default=5,
+                    help='Retries of a Salesforce call failing with a transient error')
+
+arg_parser.add_argument('-retry_rounds', action='store', dest="retry_rounds", type=int, default=2,
+                    help='Passes over events whose calls kept failing; the rest are saved to mp2sfdc_failed.json')
+
+arg_parser.add_argument('-owner_rules', action='store', dest="owner_rules",
+                    help='JSON file of rules routing tasks to owners by event, property or Contact owner; -assigned is the fallback')
+
+arg_parser.add_argument('-tenants', action='store', dest="tenants",
+                    help='JSON file of Mixpanel project -> Salesforce org jobs to run together in this process')
+
+arg_parser.add_argument('-daemon', action='store_true', dest="daemon",
+                    help='Keep running, syncing new events every -interval seconds until SIGTERM')
+
+arg_parser.add_argument('-interval', action='store', dest="interval", type=float, default=300,
+                    help='Seconds between polls in -daemon mode')
+
 passed_args = arg_parser.parse_args()
 
+if passed_args.offline and not passed_args.event_store:
+    arg_parser.error('-offline needs -event_store')
+if passed_args.tenants and (passed_args.daemon or passed_args.offline or passed_args.export_file):
+    arg_parser.error('-tenants runs live exports once; it cannot be combined with -daemon, -offline or -export_file')
+if passed_args.daemon and not passed_args.checkpoint:
+    arg_parser.error('-daemon needs -checkpoint to know where each poll starts')
+
 print passed_args
 
 token = passed_args.token
@@ -51,6 +155,12 @@ EVENTS_TO_TRACK = passed_args.events
 SANDBOX = passed_args.sandbox
 DATE_START, DATE_END = passed_args.dates #Date interval to request 
 SUBJECT_COMPONENTS = passed_args.subject_components
+BATCH_SIZE = 200 #Events per Salesforce lookup batch
+STATS = RunStats()
+#Set by SIGTERM/SIGINT in -daemon mode: finish what was read, then exit
+STOP = threading.Event()
+#Jobs of a -tenants run, reported per tenant in the summary
+TENANTS = []
 
 
 filename = "log" if os.path.isdir("log") else "/var/log"
@@ -66,41 +176,278 @@ logging.basicConfig(filename='%s/mp2sfdc_zap.log' % filename,
 def format_days_ago_in_y_m_d(d):
     return (datetime.date.today() - datetime.timedelta(days=d)).strftime("%Y-%m-%d")
 
-def call_mp():
+CHECKPOINT = Checkpoint(passed_args.checkpoint) if passed_args.checkpoint else None
+EVENT_STORE = None
+tracemalloc = None
+FROM_DATE = (CHECKPOINT and CHECKPOINT.from_date()) or format_days_ago_in_y_m_d(DATE_START)
+TO_DATE = format_days_ago_in_y_m_d(DATE_END)
+
+def call_mp(from_date, to_date, session = None, api_key = None, api_secret = None, events = None, stats = None):
+    '''Mixpanel export of the window; key, secret, events and stats default to the command line's'''
+    from src.mixpanel_api import Mixpanel, make_session
     mixpanel = Mixpanel(
-        api_key = passed_args.mp_api_key,
-        api_secret = passed_args.mp_api_secret
+        api_key = api_key or passed_args.mp_api_key,
+        api_secret = api_secret or passed_args.mp_api_secret,
+        #One keep-alive connection per in-flight shard
+        session = session or make_session(pool_size = max(passed_args.max_in_flight, 1)),
+        stats = stats or STATS
     )
+    events = EVENTS_TO_TRACK if events is None else events
     
-    mixpanel.request(['export'], 
-        {
-        # if you want to specify an event, you can do that here:
-        #'event': ['some event', 'some other event'],
+    if passed_args.export_file:
+        mixpanel.load_file(passed_args.export_file, passed_args.parse_processes)
+        return mixpanel
+
+    params = {
         # if you want to specify a filter, you can do that here:
         #'where': '"Marshall" in properties["some property"]',
-        'to_date': format_days_ago_in_y_m_d(DATE_END),
-        'from_date': format_days_ago_in_y_m_d(DATE_START)
-        })
+        'to_date': to_date,
+        'from_date': from_date
+        }
+    if events:
+        #Let Mixpanel drop untracked events before they are sent
+        params['event'] = events
+    if passed_args.shard_days:
+        mixpanel.request_shards(['export'], params,
+            days_per_shard = passed_args.shard_days, max_in_flight = passed_args.max_in_flight)
+    else:
+        mixpanel.request(['export'], params, stream=True)
     return mixpanel
 
+def open_lookup_cache():
+    if not (passed_args.lookup_cache or passed_args.clear_cache):
+        return None
+    from src.lookup_cache import LookupCache
+    cache = LookupCache('%s/mp2sfdc_lookup.sqlite' % filename,
+            ttl = passed_args.cache_ttl * 3600, negative_ttl = passed_args.negative_cache_ttl * 3600)
+    if passed_args.clear_cache:
+        cache.invalidate()
+    return cache
+
+def load_router(path):
+    if not path:
+        return None
+    from src.routing import OwnerRouter
+    return OwnerRouter.load(path)
+
 def call_sf_api():
-    return SalesforceApi(password = sfdc_pass, username = sfdc_username,
+    from src.salesforce_mp_zap import SalesforceApi
+    #Logs in on the first Salesforce call, so runs without events never do
+    return SalesforceApi(lazy_login = True, password = sfdc_pass, username = sfdc_username,
             security_token = token, sandbox = SANDBOX, assigned_to = passed_args.assigned_to,
-            subject_components = passed_args.subject_components, task_status = passed_args.task_status)
-
-if __name__ == '__main__':
-
-    salesforce_api = call_sf_api()
-    mixpanel = call_mp()
-    stub = {"event":"Report Preview Clicked","properties":{"time":1426700933,"distinct_id":"jonathanleslie73@gmail.com","$browser":"Chrome","$city":"Jamaica","$initial_referrer":"$direct","$initial_referring_domain":"$direct","$lib_version":"2.4.0","$os":"Mac OS X","$referrer":"http://novarica.com/wp-login.php?redirect_to=http%3A%2F%2Fnovarica.com%2Fb_and_t_trends_workers_comp_2014%2F","$referring_domain":"novarica.com","$region":"New York","$screen_height":800,"$screen_width":1280,"Report Name":"Business and Technology Trends: Workers&#8217; Compensation","mp_country_code":"US","mp_lib":"web"}}    
-    
-    events = mixpanel.generate_salesforce_task_objects_by_event_type(EVENTS_TO_TRACK)
-    for event in events:
+            subject_components = passed_args.subject_components, task_status = passed_args.task_status,
+            api_rate = passed_args.api_rate, api_burst = passed_args.api_burst,
+            api_max_rate = passed_args.api_max_rate, api_max_in_flight = passed_args.api_max_in_flight,
+            max_retries = passed_args.max_retries,
+            activity_since = FROM_DATE, lookup_cache = open_lookup_cache(), stats = STATS,
+            router = load_router(passed_args.owner_rules),
+            saved_users_size = passed_args.contact_cache_size, searched_records_size = passed_args.task_cache_size)
+
+def sync(salesforce_api, events):
+    '''Yields (event, added) for every event, in order'''
+    from src import pipeline
+    return pipeline.sync(salesforce_api, events, passed_args.workers, BATCH_SIZE, passed_args.engine)
+
+def day_bounds(from_date, to_date):
+    '''First and last second of a from_date..to_date window, local time like the task dates'''
+    start = datetime.datetime.strptime(from_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(to_date, "%Y-%m-%d") + datetime.timedelta(days=1)
+    return int(time.mktime(start.timetuple())), int(time.mktime(end.timetuple())) - 1
+
+def read_events(from_date, to_date, session = None):
+    '''Tracked events for the window, from the local store or the Mixpanel export'''
+    if passed_args.offline:
+        return event_store().query(EVENTS_TO_TRACK, *day_bounds(from_date, to_date))
+    events = call_mp(from_date, to_date, session).generate_salesforce_task_objects_by_event_type(EVENTS_TO_TRACK)
+    return event_store().store(events) if passed_args.event_store else events
+
+def event_store():
+    '''The -event_store EventStore, opened on first use and kept for later polls'''
+    global EVENT_STORE
+    if EVENT_STORE is None:
+        from src.event_store import EventStore
+        EVENT_STORE = EventStore(passed_args.event_store)
+    return EVENT_STORE
+
+def save_failed(events, stats = STATS, name = 'mp2sfdc_failed'):
+    '''Appends events that could not be synced to <name>.json in the log directory, replayable with -export_file'''
+    if not events:
+        return
+    path = '%s/%s.json' % (filename, name)
+    with open(path, 'a') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+    stats.incr('retry.failed', len(events))
+    logging.error('%d events still failing after retries, saved to %s' % (len(events), path))
+
+def commit_checkpoint(checkpoint, salesforce_api):
+    '''
+    Persists the mark unless events are still queued for retry: they only live in memory
+    until retry_failed, which commits once they are created or saved
+    '''
+    if not salesforce_api.retry_queue:
+        checkpoint.commit()
+
+def retry_failed(salesforce_api, stats = STATS, name = 'mp2sfdc_failed', checkpoint = None):
+    '''
+    Replays salesforce_api's retry queue for -retry_rounds passes, then saves what still fails
+    and commits checkpoint, if given
+    '''
+    for round_ in range(passed_args.retry_rounds):
+        retries = salesforce_api.drain_retry_queue()
+        if not retries:
+            break
+        logging.info('Retrying %d events, round %d' % (len(retries), round_ + 1))
+        for event, added in sync(salesforce_api, iter(retries)):
+            if added: stats.incr('retry.created')
+    save_failed(salesforce_api.drain_retry_queue(), stats, name)
+    if checkpoint:
+        checkpoint.commit()
+
+def run():
+    process(call_sf_api(), FROM_DATE, TO_DATE)
+
+def process(salesforce_api, from_date, to_date, session = None):
+    '''Syncs the from_date..to_date window; stops reading new events once STOP is set'''
+    events = read_events(from_date, to_date, session)
+    if CHECKPOINT:
+        events = itertools.ifilter(CHECKPOINT.is_new, events)
+    #Events already handed to workers still finish
+    events = itertools.takewhile(lambda event: not STOP.is_set(), events)
+    if passed_args.coalesce:
+        events = salesforce_api.coalesce_events(events, passed_args.coalesce_counts)
+    processed = []
+    for event, added in sync(salesforce_api, events):
+        STATS.incr('events.processed')
         print "add '%s' event to %s for user %s" % \
                 (str(event['event']), "Sandbox" if SANDBOX else "Production", event['properties']['distinct_id'])
-        added = salesforce_api.create_sfdc_task_from_mp_object(event)
         if added: print "Success!"
+        if CHECKPOINT:
+            processed.append(event)
+            if len(processed) >= BATCH_SIZE:
+                CHECKPOINT.advance(processed)
+                commit_checkpoint(CHECKPOINT, salesforce_api)
+                processed = []
+    if CHECKPOINT and processed:
+        CHECKPOINT.advance(processed)
+
+    retry_failed(salesforce_api, checkpoint = CHECKPOINT)
+    logging.info('Throttled %.2fs by the Salesforce rate limiter' % salesforce_api.rate_limiter.throttled)
+
+def tenant_events(config, from_date, to_date, session, stats):
+    '''A tenant's tracked events; the export is only requested once the scheduler first reads it'''
+    mixpanel = call_mp(from_date, to_date, session, config['mp_api_key'], config['mp_api_secret'],
+        config['events'], stats)
+    for event in mixpanel.generate_salesforce_task_objects_by_event_type(config['events']):
+        yield event
+
+def run_tenants(path):
+    '''
+    Runs every job in the -tenants file in this process: one Mixpanel session and one
+    Salesforce connection pool shared by all, a rate limiter, checkpoint and RunStats per tenant,
+    and -workers threads taking turns between tenants batch by batch
+    '''
+    import requests
+    from src.mixpanel_api import make_session
+    from src.salesforce_mp_zap import SalesforceApi
+    from src.tenants import load_tenants, Tenant, FairScheduler
+    configs = load_tenants(path)
+    pool_size = max(passed_args.workers, 1)
+    session = make_session(pool_size = pool_size)
+    #One pool per Salesforce instance host, each as large as the workers that may share it
+    sf_adapter = requests.adapters.HTTPAdapter(pool_connections = max(len(configs), 1), pool_maxsize = pool_size)
+    for config in configs:
+        stats = RunStats()
+        checkpoint = Checkpoint(config['checkpoint']) if config['checkpoint'] else None
+        from_date = (checkpoint and checkpoint.from_date()) or format_days_ago_in_y_m_d(DATE_START)
+        salesforce_api = SalesforceApi(lazy_login = True, http_adapter = sf_adapter,
+            username = config['username'], password = config['password'],
+            security_token = config['security_token'], sandbox = config['sandbox'],
+            assigned_to = config['assigned_to'], subject_components = config['subject_components'],
+            task_status = config['task_status'], api_rate = config['api_rate'], api_burst = config['api_burst'],
+            api_max_rate = config['api_max_rate'], api_max_in_flight = passed_args.api_max_in_flight,
+            max_retries = passed_args.max_retries, activity_since = from_date, stats = stats,
+            router = load_router(config['owner_rules']),
+            saved_users_size = passed_args.contact_cache_size, searched_records_size = passed_args.task_cache_size)
+        #A checkpoint already past the window has nothing to export
+        events = tenant_events(config, from_date, TO_DATE, session, stats) if from_date <= TO_DATE else iter([])
+        if checkpoint:
+            events = itertools.ifilter(checkpoint.is_new, events)
+        TENANTS.append(Tenant(config['name'], salesforce_api, events, stats, checkpoint))
+
+    for tenant, batch, results in FairScheduler(TENANTS, pool_size, BATCH_SIZE).run():
+        tenant.stats.incr('events.processed', len(batch))
+        STATS.incr('events.processed', len(batch))
+        if tenant.checkpoint:
+            tenant.checkpoint.advance(batch)
+            commit_checkpoint(tenant.checkpoint, tenant.salesforce_api)
+    for tenant in TENANTS:
+        if not tenant.error:
+            retry_failed(tenant.salesforce_api, tenant.stats, 'mp2sfdc_failed_%s' % tenant.name, tenant.checkpoint)
+
+def stop(signum, frame):
+    logging.info('Signal %d received, stopping after in-flight work' % signum)
+    STOP.set()
+
+def daemon(summary_path):
+    '''
+    Polls Mixpanel every -interval seconds from the checkpoint through today, keeping the
+    Salesforce session (logging in again on expiry), owner id, caches and HTTP pools warm
+    '''
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    salesforce_api = call_sf_api()
+    from src.mixpanel_api import make_session
+    session = make_session(pool_size = max(passed_args.max_in_flight, 1))
+    while not STOP.is_set():
+        started = time.time()
+        CHECKPOINT.rebase()
+        #Contacts may have been created since the last poll
+        salesforce_api.forget_invalid_users()
+        from_date = CHECKPOINT.from_date() or FROM_DATE
+        try:
+            process(salesforce_api, from_date, format_days_ago_in_y_m_d(0), session)
+        except Exception:
+            #One bad poll should not end the service; the checkpoint holds the last good batch
+            logging.exception('Sync from %s failed' % from_date)
+            STATS.incr('daemon.failed_polls')
+        STATS.incr('daemon.polls')
+        write_summary(summary_path)
+        STOP.wait(max(0, passed_args.interval - (time.time() - started)))
+    logging.info('Stopped')
+
+def write_summary(summary_path):
+    extra = {}
+    if TENANTS:
+        extra['tenants'] = dict((tenant.name, dict(tenant.stats.summary(),
+            error = tenant.error and str(tenant.error))) for tenant in TENANTS)
+    if passed_args.profile and tracemalloc:
+        top = tracemalloc.take_snapshot().statistics('lineno')[:20]
+        extra['tracemalloc_top'] = [str(stat) for stat in top]
+    STATS.write_json(summary_path, **extra)
 
+if __name__ == '__main__':
 
-
-
+    if FROM_DATE > TO_DATE and not passed_args.daemon:
+        print "Checkpoint %s is past %s, nothing to export" % (FROM_DATE, TO_DATE)
+        sys.exit(0)
+
+    summary_path = passed_args.summary or '%s/mp2sfdc_summary.json' % filename
+    if passed_args.profile:
+        import cProfile
+        try:
+            import tracemalloc
+            tracemalloc.start()
+        except ImportError:
+            pass
+        cProfile.run('daemon(summary_path)' if passed_args.daemon else
+            'run_tenants(passed_args.tenants)' if passed_args.tenants else 'run()',
+            os.path.splitext(summary_path)[0] + '.prof')
+    elif passed_args.daemon:
+        daemon(summary_path)
+    elif passed_args.tenants:
+        run_tenants(passed_args.tenants)
+    else:
+        run()
+
+    write_summary(summary_path)
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools, json, sqlite3
+
+from .checkpoint import Checkpoint
+
+
+class EventStore(object):
+
+    '''
+    Local SQLite copy of exported Mixpanel events, indexed by event name, distinct_id and time.
+    Events are keyed by their fingerprint, so storing the same export twice is a no-op.
+    '''
+
+    def __init__(self, path):
+        #Reads and writes may happen on a pipeline feeder thread, one thread at a time
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS events (fingerprint TEXT PRIMARY KEY, '
+                          'event TEXT, distinct_id TEXT, time INTEGER, body TEXT NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS events_event_time ON events (event, time)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS events_distinct_id ON events (distinct_id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS events_time ON events (time)')
+        self.conn.commit()
+
+    @staticmethod
+    def _row(event):
+        properties = event.get('properties') or {}
+        distinct_id = properties.get('distinct_id')
+        return (Checkpoint.fingerprint(event), event.get('event'),
+                None if distinct_id is None else unicode(distinct_id),
+                properties.get('time'), json.dumps(event))
+
+    def upsert(self, events):
+        '''Stores events, replacing any already stored. Returns how many were written'''
+        with self.conn:
+            cursor = self.conn.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)',
+                                           (self._row(event) for event in events))
+        return cursor.rowcount
+
+    def store(self, events, batch_size=1000):
+        '''Yields events unchanged, upserting them in batches along the way'''
+        events = iter(events)
+        for batch in iter(lambda: list(itertools.islice(events, batch_size)), []):
+            self.upsert(batch)
+            for event in batch:
+                yield event
+
+    def query(self, events=None, from_time=None, to_time=None, distinct_id=None):
+        '''Yields stored events matching the filters in time order; times are inclusive'''
+        clauses, args = [], []
+        if events:
+            events = list(events)
+            clauses.append('event IN (%s)' % ','.join('?' * len(events)))
+            args.extend(e.decode('utf-8') if isinstance(e, str) else e for e in events)
+        if from_time is not None:
+            clauses.append('time >= ?')
+            args.append(from_time)
+        if to_time is not None:
+            clauses.append('time <= ?')
+            args.append(to_time)
+        if distinct_id is not None:
+            clauses.append('distinct_id = ?')
+            args.append(distinct_id)
+        sql = 'SELECT body FROM events'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        for (body,) in self.conn.execute(sql + ' ORDER BY time', args):
+            yield json.loads(body)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+try:
+    import gevent, gevent.monkey, gevent.queue
+except ImportError:
+    gevent = None
+
+from .pipeline import SyncPipeline
+
+
+def patch():
+    '''
+    Makes sockets, sleeps and locks cooperative, so the Mixpanel export, Salesforce
+    calls and the rate limiter all yield to the event loop. Call it before any connection is opened.
+    '''
+    if gevent is None:
+        raise ImportError('the gevent engine needs gevent installed (pip install gevent)')
+    gevent.monkey.patch_all()
+
+
+class GeventPipeline(SyncPipeline):
+
+    '''
+    SyncPipeline on greenlets instead of threads: one event loop runs up to
+    concurrency lanes, each a worker with the same per-user partitioning, batching
+    and dedupe as the threaded pipeline, so results are identical.
+    '''
+
+    def __init__(self, salesforce_api, concurrency=100, batch_size=200, linger=0.05):
+        if gevent is None:
+            raise ImportError('the gevent engine needs gevent installed (pip install gevent)')
+        super(GeventPipeline, self).__init__(salesforce_api, concurrency, batch_size, linger)
+        self.Queue, self.Empty, self.Full = gevent.queue.Queue, gevent.queue.Empty, gevent.queue.Full
+        if not gevent.monkey.is_module_patched('socket'):
+            logging.warning('gevent engine running without patch(): Salesforce calls will block the event loop')
+
+    def _spawn(self, target, *args):
+        gevent.spawn(target, *args)
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3, threading, time
+
+
+class LookupCache(object):
+
+    '''
+    On-disk email -> ContactId cache shared between runs.
+    A NULL contact id records an email that was invalid or had no Contact.
+    Entries expire after ttl seconds (negative_ttl for NULLs).
+    '''
+
+    def __init__(self, path, ttl=7 * 86400, negative_ttl=86400, clock=time.time):
+        self.ttl, self.negative_ttl = ttl, negative_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        #timeout makes concurrent runs wait on each other's writes instead of failing
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS contacts '
+                          '(email TEXT PRIMARY KEY, contact_id TEXT, checked_at REAL NOT NULL)')
+        self.conn.commit()
+
+    def get_many(self, emails):
+        '''Returns {email: contact id or None} for emails with a fresh entry'''
+        now, found = self._clock(), {}
+        keys = dict((email.lower(), email) for email in emails)
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys.keys()[i:i + 500]
+                rows = self.conn.execute('SELECT email, contact_id, checked_at FROM contacts WHERE email IN (%s)'
+                                         % ','.join('?' * len(chunk)), chunk)
+                for key, contact_id, checked_at in rows:
+                    ttl = self.ttl if contact_id else self.negative_ttl
+                    if now - checked_at < ttl:
+                        found[keys[key]] = contact_id
+        return found
+
+    def set_many(self, mapping):
+        '''Stores {email: contact id or None}'''
+        now = self._clock()
+        with self._lock:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO contacts VALUES (?, ?, ?)',
+                                      [(email.lower(), contact_id, now) for email, contact_id in mapping.items()])
+
+    def invalidate(self, emails=None):
+        '''Drops the given emails, or everything'''
+        with self._lock:
+            with self.conn:
+                if emails is None:
+                    self.conn.execute('DELETE FROM contacts')
+                else:
+                    self.conn.executemany('DELETE FROM contacts WHERE email = ?',
+                                          [(email.lower(),) for email in emails])
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections, threading
+
+
+class LRUCache(object):
+
+    '''
+    Thread-safe dict holding at most maxsize keys (None for unbounded), evicting the least recently used.
+    Membership tests and get() count as hits or misses; evictions are also counted
+    in stats as cache.<name>.evicted when a RunStats is given.
+    '''
+
+    def __init__(self, maxsize=None, name='lru', stats=None):
+        self.maxsize = maxsize
+        self.name = name
+        self.stats = stats
+        self.hits = self.misses = self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._data:
+                self._touch(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data[key]
+            self._touch(key)
+            return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self:
+                return self._data[key]
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            self._evict()
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self[key] = default
+            return self[key]
+
+    def update(self, items):
+        with self._lock:
+            for key, value in dict(items).iteritems():
+                self[key] = value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def discard_value(self, value):
+        '''Drops every key holding value; returns how many were dropped'''
+        with self._lock:
+            keys = [key for key, held in self._data.iteritems() if held == value]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def info(self):
+        '''{'size', 'maxsize', 'hits', 'misses', 'evictions'}'''
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _touch(self, key):
+        self._data[key] = self._data.pop(key)
+
+    def _evict(self):
+        while self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+            if self.stats:
+                self.stats.incr('cache.%s.evicted' % self.name)
@@ -23,7 +23,16 @@ import hashlib
 import urllib
 import time
 import sys
+import logging
+import tempfile
+import os
+import marshal
 import csv, codecs, cStringIO
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.packages.urllib3.util.retry import Retry
+from .stats import RunStats
 try:
     import json
 except ImportError:
@@ -54,6 +63,67 @@ def getSubKeys(listOfDicts):
             pass
     return subkeys
 
+def make_session(pool_size=10, retries=3, backoff_factor=0.5):
+    '''
+    requests session keeping up to pool_size keep-alive connections per host.
+    Connection errors and 5xx responses are retried with exponential backoff;
+    responses are gzip-compressed on the wire and decoded transparently.
+    Share one session between Mixpanel clients to share its pool.
+    '''
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[500, 502, 503, 504]))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def split_ranges(path, size):
+    """(start, end) byte ranges of about size covering the file at path, each ending on a line boundary"""
+    total = os.path.getsize(path)
+    ranges, start = [], 0
+    with open(path, 'rb') as f:
+        while start < total:
+            f.seek(min(start + size, total))
+            f.readline()
+            end = min(f.tell(), total)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _match_lines(lines, events, tally):
+    """
+    yields parsed export lines--filtered by events if provided.
+    Lines that name some other event in their opening bytes are skipped without json.loads.
+    tally collects [parsed, prefiltered, parse seconds]
+    """
+    prefixes = Mixpanel.event_prefixes(events) if events else ()
+    for line in lines:
+        if not line.strip():
+            continue
+        if events and line.startswith('{"event":"') and not line.startswith(prefixes):
+            tally[1] += 1
+            continue
+        start = time.time()
+        event_dict = json.loads(line)
+        tally[2] += time.time() - start
+        tally[0] += 1
+        if not events or event_dict['event'] in events:
+            yield event_dict
+
+
+def _parse_range(job):
+    """process pool worker: the matching events of one byte range, plus its parse tally"""
+    path, start, end, events = job
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split('\n')
+    tally = [0, 0, 0.0]
+    matched = list(_match_lines(lines, events, tally))
+    return [matched] + tally
+
+
 class UTF8Recoder:
     """
     Iterator that reads an encoded stream and reencodes the input to UTF-8
@@ -74,14 +144,21 @@ class UnicodeWriter:
     """
 
     def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
+        self.stream = f
+        # UTF-8 output needs no re-encoding, so write straight to the file
+        self.direct = codecs.lookup(encoding).name == 'utf-8'
+        if self.direct:
+            self.writer = csv.writer(f, dialect=dialect, **kwds)
+            return
         # Redirect output to a queue
         self.queue = cStringIO.StringIO()
         self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
         self.encoder = codecs.getincrementalencoder(encoding)()
 
     def writerow(self, row): 
         self.writer.writerow([s.encode("utf-8") for s in row])
+        if self.direct:
+            return
         # Fetch UTF-8 output from the queue ...
         data = self.queue.getvalue()
         data = data.decode("utf-8")
@@ -100,18 +177,57 @@ class Mixpanel(object):
 
     ENDPOINT = 'http://data.mixpanel.com/api'
     VERSION = '2.0'
+    CHUNK_SIZE = 64 * 1024
+    #Bytes of an export file handed to each parse process at a time
+    RANGE_SIZE = 8 * 1024 * 1024
 
-    def __init__(self, api_key, api_secret, events_to_track = []):
+    def __init__(self, api_key, api_secret, events_to_track = [], session = None, timeout = (10, 300),
+                 stats = None):
         self.api_key = api_key
         self.api_secret = api_secret
         self.events_to_track = set(events_to_track)
-
-    def request(self, methods, params, format='json'):
+        self.data, self.stream = None, None
+        self.parse_file, self.parse_processes = None, 1
+        #Pooled keep-alive session (see make_session) and (connect, read) timeouts in seconds
+        self.session = session or make_session()
+        self.timeout = timeout
+        #export.download/export.parse timers and counters for the run summary
+        self.stats = stats or RunStats()
+
+    def request(self, methods, params, format='json', stream=False):
         """
             methods - List of methods to be joined, e.g. ['events', 'properties', 'values']
                       will give us http://mixpanel.com/api/2.0/events/properties/values/
             params - Extra parameters associated with method
+            stream - Keep the response open and read it lazily through iter_events
+                     instead of buffering the whole body in self.data
+        """
+        response = self._open(methods, params, format)
+        if stream:
+            self.data, self.stream, self.parse_file = None, iter([response]), None
+        else:
+            self.data, self.stream, self.parse_file = response.content, None, None
+
+    def request_shards(self, methods, params, days_per_shard=1, max_in_flight=4, retries=3, format='json'):
         """
+            Like request(stream=True), but splits params from_date..to_date into shards of
+            days_per_shard days, each signed and fetched on its own by up to max_in_flight threads
+            over the shared session pool.
+            A failed shard is retried alone, up to retries times.
+            Shards are read back through iter_events in date order.
+        """
+        from_date = datetime.datetime.strptime(params['from_date'], '%Y-%m-%d').date()
+        to_date = datetime.datetime.strptime(params['to_date'], '%Y-%m-%d').date()
+        shards = []
+        while from_date <= to_date:
+            shard_end = min(to_date, from_date + datetime.timedelta(days=days_per_shard - 1))
+            shard_params = dict(params, from_date=from_date.strftime('%Y-%m-%d'),
+                                to_date=shard_end.strftime('%Y-%m-%d'))
+            shards.append((methods, shard_params, format, retries))
+            from_date = shard_end + datetime.timedelta(days=1)
+        self.data, self.stream, self.parse_file = None, self._fetch_shards(shards, max_in_flight), None
+
+    def _open(self, methods, params, format):
         assert self.api_key != '' and self.api_secret != '',\
             'Your API KEY and API SECRET are not set. Add these keys to the script and run again' 
         params['api_key'] = self.api_key
@@ -121,10 +237,48 @@ class Mixpanel(object):
         params['sig'] = self.hash_args(params)
 
         request_url = '/'.join([self.ENDPOINT, str(self.VERSION)] + methods) + '/?' + self.unicode_urlencode(params)
-        print request_url
-        request = urllib.urlopen(request_url)
-        data_output = request.read()
-        self.data = data_output
+        #The signed URL stays out of the output
+        print 'Requesting %s %s to %s' % ('/'.join(methods), params.get('from_date', ''), params.get('to_date', ''))
+        response = self.session.get(request_url, stream=True, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def _chunks(self, source):
+        """decoded body chunks of a streamed response or an open file"""
+        if hasattr(source, 'iter_content'):
+            return source.iter_content(self.CHUNK_SIZE)
+        return iter(lambda: source.read(self.CHUNK_SIZE), '')
+
+    def _fetch_shards(self, shards, max_in_flight):
+        pool = ThreadPool(max_in_flight)
+        try:
+            #imap keeps shard order while later shards download in the background
+            for spool in pool.imap(self._fetch_shard, shards):
+                yield spool
+        finally:
+            pool.terminate()
+
+    def _fetch_shard(self, shard):
+        """downloads one shard into a temp file (in memory while small), retrying with backoff"""
+        methods, params, format, retries = shard
+        for attempt in range(retries + 1):
+            spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+            try:
+                response = self._open(methods, dict(params), format)
+                try:
+                    for chunk in self._chunks(response):
+                        spool.write(chunk)
+                finally:
+                    response.close()
+                spool.seek(0)
+                return spool
+            except IOError as e:
+                spool.close()
+                if attempt == retries:
+                    raise
+                logging.warning('Export shard %s..%s failed (%s), retrying' %
+                                (params['from_date'], params['to_date'], e))
+                time.sleep(2 ** attempt)
 
     def unicode_urlencode(self, params):
         """
@@ -171,38 +325,137 @@ class Mixpanel(object):
             hash.update(self.api_secret)
         return hash.hexdigest()
 
-    def generate_salesforce_task_objects_by_event_type(self, events = None):
+    def iter_lines(self):
         """
-        generates events--filted by events if provided
+        yields raw export lines, reading the open response(s) chunk by chunk
+        when streaming, so only one chunk is held in memory at a time
         """
-        event_raw = self.data.split('\n')
-        event_raw.pop()
-
-        if events: 
-            events = set(events)
+        if self.stream is None:
+            source = cStringIO.StringIO(self.data or '')
+            for line in source:
+                yield line.rstrip('\n')
+            return
+
+        sources, self.stream = self.stream, None
+        for response in self._timed_iter(sources, 'export.download'):
+            pending = ''
+            try:
+                for chunk in self._timed_iter(self._chunks(response), 'export.download'):
+                    lines = (pending + chunk).split('\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        yield line
+            finally:
+                response.close()
+            if pending:
+                yield pending
+
+    def _timed_iter(self, iterable, name):
+        """yields from iterable, adding the time spent waiting on it to the stats timer name"""
+        iterator, waited = iter(iterable), 0.0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    waited += time.time() - start
+                yield item
+        finally:
+            self.stats.add_time(name, waited, 0)
+
+    def load_file(self, path, processes = 1):
+        """
+        reads a previously downloaded export file through iter_events instead of the API.
+        With processes > 1 the file is parsed and filtered in a process pool
+        """
+        self.data, self.stream = None, iter([open(path, 'rb')])
+        self.parse_file, self.parse_processes = path, processes
 
-        event_list = []
-        for event in event_raw:
-            event_dict = json.loads(event)
-            if not events or event_dict['event'] in events:
+    @staticmethod
+    def event_prefixes(events):
+        """
+        the raw '{"event":"<name>"' openings of export lines for events,
+        in both escaped and literal UTF-8 spellings
+        """
+        prefixes = set()
+        for name in events:
+            if isinstance(name, str):
+                name = name.decode('utf-8')
+            prefixes.add('{"event":' + json.dumps(name))
+            prefixes.add('{"event":' + json.dumps(name, ensure_ascii=False).encode('utf-8'))
+        return tuple(prefixes)
+
+    def iter_events(self, events = None):
+        """
+        yields parsed export events--filtered by events if provided.
+        Lines that name some other event in their opening bytes are skipped without json.loads
+        """
+        if events:
+            #json.loads gives unicode names; compare against unicode
+            events = set(e.decode('utf-8') if isinstance(e, str) else e for e in events)
+        if self.parse_file and self.parse_processes > 1:
+            for event_dict in self._iter_file_events(events):
                 yield event_dict
+            return
 
+        tally = [0, 0, 0.0]
+        try:
+            for event_dict in _match_lines(self.iter_lines(), events, tally):
+                yield event_dict
+        finally:
+            self._add_parse_stats(*tally)
 
-    def export_csv(self):
+    def _iter_file_events(self, events):
         """
-        takes mixpanel export API json and returns a csv file
+        parses newline-aligned byte ranges of the loaded file in a process pool,
+        each worker sending back only the matching events, yielded in file order
         """
-        event_raw = self.data.split('\n')
-        outfileName = 'mixpanel_%s' %  str(int(time.time()))
-        '''remove the lost line, which is a newline'''
-        event_raw.pop()
+        for source in self.stream or ():
+            source.close()
+        path, self.stream, self.parse_file = self.parse_file, None, None
+        ranges = [(path, start, end, events) for start, end in split_ranges(path, self.RANGE_SIZE)]
+        pool = multiprocessing.Pool(self.parse_processes)
+        try:
+            for matched, parsed, prefiltered, seconds in pool.imap(_parse_range, ranges):
+                self._add_parse_stats(parsed, prefiltered, seconds)
+                for event_dict in matched:
+                    yield event_dict
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _add_parse_stats(self, parsed, prefiltered, seconds):
+        self.stats.add_time('export.parse', seconds, parsed)
+        self.stats.incr('export.prefiltered', prefiltered)
 
-        event_list = []
-        for event in event_raw:
-            event_json = json.loads(event)
-            event_list.append(event_json)
+    def generate_salesforce_task_objects_by_event_type(self, events = None):
+        """
+        generates events--filted by events if provided
+        """
+        return self.iter_events(events)
 
-        subkeys = getSubKeys(event_list)
+    def export_csv(self, columns = None, outfileName = None):
+        """
+        takes mixpanel export API json and writes a csv file, returning its name.
+        Parsed events are spooled to a temp file while the property keys are collected,
+        then written after the header in one sequential pass. Passing the property
+        columns up front skips the spool and writes rows as they are read
+        """
+        outfileName = outfileName or 'mixpanel_%s' %  str(int(time.time()))
+
+        if columns is None:
+            spool, subkeys = tempfile.TemporaryFile(), set()
+            for event in self.iter_events():
+                subkeys.update(event.get(u'properties') or {})
+                marshal.dump(event, spool)
+            spool.seek(0)
+            events, subkeys = self._read_spool(spool), sorted(subkeys)
+        else:
+            events, subkeys = self.iter_events(), columns
 
         #open the file
         f = open(outfileName, 'w')
@@ -218,20 +471,23 @@ class Mixpanel(object):
         writer.writerow(header)
 
         #write all the data rows
-        for event in event_list:
-            line = []
-            #get the event name
-            try:
-                line.append(event[u'event'])
-            except KeyError:
-                line.append("")
+        for event in events:
+            properties = event.get(u'properties') or {}
+            line = [event.get(u'event', u'')]
             #get each property value
             for subkey in subkeys:
-                try:
-                    line.append(unicode(event[u'properties'][subkey]))
-                except KeyError:
-                    line.append("")
+                line.append(unicode(properties[subkey]) if subkey in properties else u'')
             #write the line
             writer.writerow(line)
-
-
+        f.close()
+        return outfileName
+
+    @staticmethod
+    def _read_spool(spool):
+        try:
+            while True:
+                yield marshal.load(spool)
+        except EOFError:
+            pass
+        finally:
+            spool.close()
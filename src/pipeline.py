@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools, sys, threading, zlib
+import Queue
+
+
+class SyncPipeline(object):
+
+    '''
+    Runs SalesforceApi.create_sfdc_tasks_from_mp_objects on a pool of worker threads,
+    so parsing, contact resolution and task creation overlap.
+    Events are partitioned by distinct_id: one user's events always go to the same
+    worker, in order, so two workers never create the same task.
+    A worker error, or the caller no longer iterating, cancels the feeder and the other workers.
+    '''
+
+    _DONE = object()
+    Queue, Empty, Full = Queue.Queue, Queue.Empty, Queue.Full
+    #Seconds between cancellation checks while blocked on a queue
+    POLL = 0.1
+
+    def __init__(self, salesforce_api, workers=4, batch_size=200, linger=0.05):
+        self.salesforce_api = salesforce_api
+        self.workers = workers
+        self.batch_size = batch_size
+        #Seconds a worker waits for more events before sending a partial batch
+        self.linger = linger
+
+    @staticmethod
+    def partition_key(event):
+        try:
+            return unicode(event['properties']['distinct_id']).lower().encode('utf-8')
+        except (KeyError, TypeError):
+            return ''
+
+    def run(self, events):
+        '''Yields (event, result) for every event, in input order'''
+        cancel = threading.Event()
+        inboxes = [self.Queue(self.batch_size * 2) for i in range(self.workers)]
+        outbox = self.Queue()
+        for inbox in inboxes:
+            self._spawn(self._work, inbox, outbox, cancel)
+        self._spawn(self._feed, events, inboxes, outbox, cancel)
+
+        #Results come back per worker; hold early ones until their turn
+        done, next_seq, total = {}, 0, None
+        try:
+            while total is None or next_seq < total:
+                seq, event, result = outbox.get()
+                if seq is self._DONE:
+                    if event is not None:
+                        raise event[0], event[1], event[2]
+                    if result is not None:
+                        total = result
+                    continue
+                done[seq] = (event, result)
+                while next_seq in done:
+                    yield done.pop(next_seq)
+                    next_seq += 1
+        finally:
+            #Also reached when the caller closes or drops this generator early
+            cancel.set()
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _put(self, queue, item, cancel):
+        '''Puts item on a bounded queue unless cancel is set first; returns whether it was put'''
+        while not cancel.is_set():
+            try:
+                queue.put(item, timeout=self.POLL)
+                return True
+            except self.Full:
+                pass
+        return False
+
+    def _feed(self, events, inboxes, outbox, cancel):
+        seq = 0
+        try:
+            for event in events:
+                inbox = inboxes[zlib.crc32(self.partition_key(event)) % len(inboxes)]
+                if not self._put(inbox, (seq, event), cancel):
+                    return
+                seq += 1
+        except Exception:
+            outbox.put((self._DONE, sys.exc_info(), None))
+            return
+        finally:
+            for inbox in inboxes:
+                self._put(inbox, self._DONE, cancel)
+        outbox.put((self._DONE, None, seq))
+
+    def _work(self, inbox, outbox, cancel):
+        finished = False
+        while not finished and not cancel.is_set():
+            try:
+                item = inbox.get(timeout=self.POLL)
+            except self.Empty:
+                continue
+            if item is self._DONE:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = inbox.get(timeout=self.linger)
+                except self.Empty:
+                    break
+                if item is self._DONE:
+                    finished = True
+                    break
+                batch.append(item)
+            if cancel.is_set():
+                break
+            try:
+                results = self.salesforce_api.create_sfdc_tasks_from_mp_objects([event for seq, event in batch])
+            except Exception:
+                cancel.set()
+                outbox.put((self._DONE, sys.exc_info(), None))
+                return
+            for (seq, event), result in zip(batch, results):
+                outbox.put((seq, event, result))
+
+
+def sync(salesforce_api, events, workers=1, batch_size=200, engine='threads'):
+    '''
+    Yields (event, added) for every event, in order: through a GeventPipeline for the gevent
+    engine, a SyncPipeline for several workers, else batch by batch on this thread
+    '''
+    if engine == 'gevent':
+        from .gevent_pipeline import GeventPipeline
+        return GeventPipeline(salesforce_api, workers, batch_size).run(events)
+    if workers > 1:
+        return SyncPipeline(salesforce_api, workers, batch_size).run(events)
+    return ((event, added) for batch in iter(lambda: list(itertools.islice(events, batch_size)), [])
+            for event, added in zip(batch, salesforce_api.create_sfdc_tasks_from_mp_objects(batch)))
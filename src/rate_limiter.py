@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading, time
+from contextlib import contextmanager
+
+
+class TokenBucket(object):
+
+    '''
+    Thread-safe token bucket: allows `rate` calls per second on average and bursts of up to `burst`.
+    Callers that run out of tokens reserve future ones and sleep outside the lock.
+    '''
+
+    def __init__(self, rate=20, burst=20, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        #Total seconds callers have spent waiting for tokens
+        self.throttled = 0.0
+        self._clock, self._sleep = clock, sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            now = self._clock()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.rate = float(rate)
+
+    def acquire(self, tokens=1):
+        '''Takes tokens, sleeping until they are available. Returns seconds waited'''
+        with self._lock:
+            now = self._clock()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            wait = max(0.0, (tokens - self.tokens) / self.rate)
+            self.tokens -= tokens
+            self.throttled += wait
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class AdaptiveRate(object):
+
+    '''
+    AIMD control of a TokenBucket's rate and of how many calls may be in flight at once.
+    Successes raise the rate by about `increase` calls/s per second and the in-flight limit by
+    about one per round of calls; a throttle signal (limit error, 503, near-exhausted API usage)
+    multiplies both by `decrease`, at most once per `cooldown` seconds.
+    '''
+
+    def __init__(self, bucket, min_rate=1, max_rate=None, max_in_flight=64, increase=1.0, decrease=0.5,
+                 cooldown=1.0, usage_high_water=0.9, clock=time.time):
+        self.bucket = bucket
+        self.min_rate, self.max_rate = float(min_rate), max_rate
+        self.max_in_flight = max_in_flight
+        self.in_flight_limit = float(max_in_flight)
+        self.increase, self.decrease, self.cooldown = increase, decrease, cooldown
+        #Fraction of the org's API allowance (Sforce-Limit-Info) past which we back off
+        self.usage_high_water = usage_high_water
+        self.in_flight = 0
+        self.decreases = 0
+        self._clock = clock
+        self._last_decrease = None
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        '''Holds one of the in-flight slots for the duration of a call'''
+        with self._cond:
+            while self.in_flight >= max(1, int(self.in_flight_limit)):
+                self._cond.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify()
+
+    def on_success(self):
+        with self._cond:
+            rate = self.bucket.rate + self.increase / self.bucket.rate
+            if self.max_rate:
+                rate = min(rate, self.max_rate)
+            self.bucket.set_rate(rate)
+            self.in_flight_limit = min(self.max_in_flight, self.in_flight_limit + 1.0 / self.in_flight_limit)
+            self._cond.notify()
+
+    def on_throttle(self):
+        '''Backs off; returns False if a decrease happened within cooldown and this one was skipped'''
+        with self._cond:
+            now = self._clock()
+            if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+                return False
+            self._last_decrease = now
+            self.decreases += 1
+            self.bucket.set_rate(max(self.min_rate, self.bucket.rate * self.decrease))
+            self.in_flight_limit = max(1.0, self.in_flight_limit * self.decrease)
+            return True
+
+    def on_usage(self, used, limit):
+        '''Feeds an api-usage=used/limit reading from the Sforce-Limit-Info header'''
+        if limit and float(used) / limit >= self.usage_high_water:
+            return self.on_throttle()
+        return False
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+
+class OwnerRouter(object):
+
+    '''
+    Ordered rules picking a task's owner; the first rule whose conditions all match wins.
+    A rule has optional conditions "event" (a name or list of names) and "property" with
+    "values" (the event property must be one of them), and an outcome: "owner", a User name,
+    or "contact_owner": true for the Contact's own OwnerId. Tasks no rule matches go to
+    the default assignee. Matching is in memory; SalesforceApi bulk-loads the ids.
+    '''
+
+    CONDITIONS = ('event', 'property', 'values')
+
+    def __init__(self, rules):
+        for rule in rules:
+            unknown = set(rule) - set(self.CONDITIONS) - set(['owner', 'contact_owner'])
+            if unknown:
+                raise ValueError('Unknown keys %s in owner rule %s' % (', '.join(sorted(unknown)), rule))
+            if ('owner' in rule) == bool(rule.get('contact_owner')):
+                raise ValueError('Owner rule %s needs exactly one of "owner" or "contact_owner"' % rule)
+            if ('property' in rule) != ('values' in rule):
+                raise ValueError('Owner rule %s needs both "property" and "values"' % rule)
+        self.rules = [dict(rule, event=self._names(rule.get('event'))) for rule in rules]
+
+    @classmethod
+    def load(cls, path):
+        '''Rules from a JSON file of the form {"rules": [...]}'''
+        with open(path) as f:
+            return cls(json.load(f)['rules'])
+
+    @staticmethod
+    def _names(event):
+        if event is None:
+            return None
+        return set([event]) if isinstance(event, basestring) else set(event)
+
+    @property
+    def owner_names(self):
+        '''User names the rules can route to'''
+        return set(rule['owner'] for rule in self.rules if 'owner' in rule)
+
+    @property
+    def needs_contact_owner(self):
+        return any(rule.get('contact_owner') for rule in self.rules)
+
+    def match(self, event_name, properties):
+        '''The first rule matching the event, or None'''
+        for rule in self.rules:
+            if rule['event'] is not None and event_name not in rule['event']:
+                continue
+            if 'property' in rule and properties.get(rule['property']) not in rule['values']:
+                continue
+            return rule
+        return None
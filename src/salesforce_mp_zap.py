@@ -22,25 +22,187 @@
 
 
 from simple_salesforce import Salesforce
+from simple_salesforce.api import SalesforceError, SalesforceRefusedRequest, SalesforceGeneralError, \
+    SalesforceExpiredSession
 from validate_email import validate_email
-import logging, sys, json, datetime, time
+from .rate_limiter import TokenBucket, AdaptiveRate
+from .stats import RunStats
+from .lru_cache import LRUCache
+import logging, sys, json, datetime, time, threading, re, collections, itertools, random
+import requests
+
+#saved_users.get default telling an uncached email from a cached invalid one
+_UNKNOWN = object()
 
 
 class CustomMPDataError(Exception):
     pass
 
+class DuplicateTaskError(CustomMPDataError):
+    pass
+
 class SalesforceApi(Salesforce):
 
     '''Wrapper on the API that handles a mixpanel object, makes Task creation easier, handles logging'''
 
+    #Max values per IN (...) clause and max SOQL statement length
+    QUERY_BATCH_SIZE = 200
+    MAX_SOQL_LENGTH = 20000
+    #Max records per sObject Collections request
+    COLLECTION_SIZE = 200
+    #Server errors worth retrying; POSTs are only retried on 503, which means nothing was done
+    RETRY_STATUSES = (500, 502, 503, 504)
+
     def __init__(self, **kwargs):
         #This is how the subject is created:
         self.subject_components = kwargs['subject_components']
         #This is the state of the Salesforce task:
         self.task_status = kwargs["task_status"]
-        self.searched_records, self.saved_users = {}, {}
+        #Stage timers and counters for the run summary; may be shared with Mixpanel
+        self.stats = kwargs.pop('stats', None) or RunStats()
+        #LRU caches of email -> ContactId (None if invalid) and WhoId -> set of _task_key fingerprints
+        self.saved_users = LRUCache(kwargs.pop('saved_users_size', 100000), 'saved_users', self.stats)
+        self.searched_records = LRUCache(kwargs.pop('searched_records_size', 20000), 'searched_records', self.stats)
+        #Why each email got its None verdict, so later events count the real skip reason
+        self.skip_reasons = LRUCache(self.saved_users.maxsize, 'skip_reasons', self.stats)
+        #Optional OwnerRouter choosing each task's owner; its User ids and Contact owners are loaded in bulk
+        self.router = kwargs.pop('router', None)
+        self.contact_owners = LRUCache(self.saved_users.maxsize, 'contact_owners', self.stats)
+        self._owner_ids = None
+        self.pending_tasks = []
+        #Guards check-then-remember on searched_records when workers share this instance
+        self.dedupe_lock = threading.RLock()
+        #Export from_date (YYYY-MM-DD) bounding the Tasks fetched for dedupe, None for full history
+        self.activity_since = kwargs.pop('activity_since', None)
+        #Optional LookupCache persisting email -> ContactId verdicts between runs
+        self.lookup_cache = kwargs.pop('lookup_cache', None)
+        #Shared limiter charged once per Salesforce call; api_rate calls/s, api_burst at once
+        self.rate_limiter = kwargs.pop('rate_limiter', None) or \
+            TokenBucket(kwargs.pop('api_rate', 20), kwargs.pop('api_burst', 20))
+        #AIMD control of the limiter rate and of calls in flight, driven by errors and Sforce-Limit-Info
+        self.rate_control = kwargs.pop('rate_control', None) or AdaptiveRate(self.rate_limiter,
+            max_rate=kwargs.pop('api_max_rate', None), max_in_flight=kwargs.pop('api_max_in_flight', 64))
+        #Transient failures are retried max_retries times, backing off up to backoff_cap seconds
+        self.max_retries = kwargs.pop('max_retries', 5)
+        self.backoff_base, self.backoff_cap = kwargs.pop('backoff_base', 0.5), kwargs.pop('backoff_cap', 30)
+        #Events whose Salesforce calls still failed after retrying, for the caller to replay
+        self.retry_queue = []
+        #sObject Collections need API v42.0+
+        kwargs.setdefault('version', '42.0')
+        #Optional requests HTTPAdapter shared with other SalesforceApi instances, to share its connection pool
+        self.http_adapter = kwargs.pop('http_adapter', None)
+        #Kept to log in again when the session expires in a long-running process
+        self._login_kwargs = kwargs
+        self._login_lock = threading.RLock()
+        self.assigned_to, self._owner_id = kwargs["assigned_to"], None
+        #With lazy_login, log in and look up the owner only once a Salesforce call is made
+        self._logged_in = not kwargs.pop('lazy_login', False)
+        if self._logged_in:
+            self._login(**kwargs)
+            self.owner_id = self._lookup_owner_id()
+
+    @property
+    def owner_id(self):
+        '''Id of the assigned_to User, looked up on first use'''
+        if self._owner_id is None:
+            with self._login_lock:
+                if self._owner_id is None:
+                    self._owner_id = self._lookup_owner_id()
+        return self._owner_id
+
+    def _lookup_owner_id(self):
+        if self.router is None:
+            return self.get_ownerid_from_assigned_to_name(self.assigned_to)
+        owner_ids = self.owner_ids
+        if self.assigned_to not in owner_ids:
+            raise ValueError('No Salesforce User named %s' % self.assigned_to)
+        return owner_ids[self.assigned_to]
+
+    @property
+    def owner_ids(self):
+        '''{User name: Id} for assigned_to and every owner the router names, loaded with one query on first use'''
+        if self._owner_ids is None:
+            with self._login_lock:
+                if self._owner_ids is None:
+                    self._owner_ids = self._load_owner_ids(self.router.owner_names | set([self.assigned_to]))
+        return self._owner_ids
+
+    def _load_owner_ids(self, names):
+        by_name = dict((name.lower(), name) for name in names)
+        owner_ids = {}
+        for soql in self._in_queries("SELECT Id, Name FROM User WHERE Name IN (%s)", list(names)):
+            for record in self._query_records(soql):
+                owner_ids[by_name.get(record['Name'].lower(), record['Name'])] = record['Id']
+        for name in names - set(owner_ids):
+            logging.warning('No Salesforce User named %s; tasks routed to it go to %s' % (name, self.assigned_to))
+        return owner_ids
+
+    def route_owner(self, event_name, properties, contact_id):
+        '''OwnerId for a task, from the router's first matching rule or else assigned_to'''
+        rule = self.router.match(event_name, properties) if self.router else None
+        owner_id = None
+        if rule and rule.get('contact_owner'):
+            if contact_id not in self.contact_owners:
+                #Only for a contact resolved before owners were needed, e.g. from the lookup cache
+                self.prefetch_contact_owners([contact_id])
+            owner_id = self.contact_owners.get(contact_id)
+        elif rule:
+            owner_id = self.owner_ids.get(rule['owner'])
+        return owner_id or self.owner_id
+
+    def prefetch_contact_owners(self, contact_ids):
+        '''Loads OwnerIds of Contacts not yet in contact_owners with Id IN (...) queries'''
+        pending = [contact_id for contact_id in set(contact_ids) if contact_id and contact_id not in self.contact_owners]
+        for soql in self._in_queries("SELECT Id, OwnerId FROM Contact WHERE Id IN (%s)", pending):
+            for record in self._query_records(soql):
+                self.contact_owners[record['Id']] = record['OwnerId']
+
+    @owner_id.setter
+    def owner_id(self, owner_id):
+        self._owner_id = owner_id
+
+    def _ensure_login(self):
+        if not self._logged_in:
+            with self._login_lock:
+                if not self._logged_in:
+                    self._login(**self._login_kwargs)
+                    self._logged_in = True
+
+    def __getattr__(self, name):
+        #Session attributes (base_url, session_id, request...) appear once logged in
+        if not name.startswith('_') and not self.__dict__.get('_logged_in', True):
+            self._ensure_login()
+            return getattr(self, name)
+        return Salesforce.__getattr__(self, name)
+
+    def _login(self, **kwargs):
         Salesforce.__init__(self, **kwargs)
-        self.owner_id = self.get_ownerid_from_assigned_to_name(kwargs["assigned_to"])
+        #Not getattr: a missing attribute would come back as an SFType
+        session = self.__dict__.get('request')
+        if session is not None:
+            session.hooks['response'].append(self._read_limit_info)
+            if self.http_adapter:
+                session.mount('https://', self.http_adapter)
+
+    def relogin(self, expired_session_id=None):
+        '''
+        Logs in again with the original credentials. When expired_session_id is given,
+        only if no other thread has replaced that session yet
+        '''
+        with self._login_lock:
+            if expired_session_id is not None and self.__dict__.get('session_id') != expired_session_id:
+                return
+            logging.info('Salesforce session expired, logging in again')
+            self.stats.incr('api.relogin')
+            self._login(**self._login_kwargs)
+
+    def _read_limit_info(self, response, *args, **kwargs):
+        '''Response hook passing the org's API usage (Sforce-Limit-Info: api-usage=used/limit) to rate_control'''
+        match = re.search(r'api-usage=(\d+)/(\d+)', response.headers.get('Sforce-Limit-Info', ''))
+        if match:
+            self.api_usage = tuple(int(i) for i in match.groups())
+            if self.rate_control.on_usage(*self.api_usage):
+                self.stats.incr('api.throttled')
 
     @staticmethod
     def convert_time_stamp_to_sf_date_format(d):
@@ -74,60 +236,369 @@ class SalesforceApi(Salesforce):
             'Type': event_name,
             'Subject': subject,
             'Description': str(properties),
-            'OwnerId': self.owner_id
         }
 
         user_email = properties['distinct_id']
 
-        if user_email in self.saved_users and self.saved_users[user_email] is None:
-            raise CustomMPDataError('Already checked and invalid')
+        if self.saved_users.get(user_email, '') is None:
+            raise CustomMPDataError(self.skip_reasons.get(user_email, 'Already checked and invalid'))
         user_id = self.check_email_and_get_id(user_email)
         task['WhoId'] = user_id 
+        #Only looked up once some event has a contact to attach a task to
+        task['OwnerId'] = self.route_owner(event_name, properties, user_id)
         return task
 
     def _get_user_ids(self, user_email):
         '''Returns list of user_ids for email'''
-        data = self.query("SELECT Id FROM Contact WHERE Email = '%s'" % user_email)
+        if self.router and self.router.needs_contact_owner:
+            data = self.query("SELECT Id, OwnerId FROM Contact WHERE Email = '%s'" % user_email)
+            for datum in data['records']:
+                self.contact_owners[datum['Id']] = datum['OwnerId']
+        else:
+            data = self.query("SELECT Id FROM Contact WHERE Email = '%s'" % user_email)
         return [datum['Id'] for datum in data['records']]
+
+    @staticmethod
+    def _soql_quote(value):
+        return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
+    def _in_queries(self, soql, values):
+        '''
+        Yields soql with its %s filled by IN lists of quoted values,
+        split so each holds at most QUERY_BATCH_SIZE values and MAX_SOQL_LENGTH chars
+        '''
+        batch, length = [], len(soql)
+        for value in values:
+            quoted = self._soql_quote(value)
+            if batch and (len(batch) >= self.QUERY_BATCH_SIZE or
+                    length + len(quoted) + 1 > self.MAX_SOQL_LENGTH):
+                yield soql % ','.join(batch)
+                batch, length = [], len(soql)
+            batch.append(quoted)
+            length += len(quoted) + 1
+        if batch:
+            yield soql % ','.join(batch)
+
+    def _query_records(self, soql):
+        '''Yields every record of a query, following nextRecordsUrl'''
+        data = self.query(soql)
+        while True:
+            for record in data['records']:
+                yield record
+            if data.get('done', True):
+                break
+            data = self.query_more(data['nextRecordsUrl'], identifier_is_url=True)
+
+    def resolve_emails(self, emails):
+        '''
+        Looks up Contact ids for many emails at once with WHERE Email IN (...) queries.
+        Fills saved_users, with None for invalid or unknown emails, and returns {email: id or None}
+        '''
+        unique = set(emails)
+        #Held here as well, since saved_users may evict some of them before we return
+        resolved = {}
+        for email in unique:
+            user_id = self.saved_users.get(email, _UNKNOWN)
+            if user_id is not _UNKNOWN:
+                resolved[email] = user_id
+        pending = [email for email in unique if email not in resolved]
+        self.stats.incr('cache.saved_users.hit', len(unique) - len(pending))
+        self.stats.incr('cache.saved_users.miss', len(pending))
+        if self.lookup_cache and pending:
+            cached = self.lookup_cache.get_many(pending)
+            self.saved_users.update(cached)
+            resolved.update(cached)
+            pending = [email for email in pending if email not in cached]
+            self.stats.incr('cache.lookup_cache.hit', len(cached))
+            self.stats.incr('cache.lookup_cache.miss', len(pending))
+
+        verdicts = {}
+        with self.stats.timed('validate_email'):
+            for email in pending:
+                if not validate_email(email):
+                    verdicts[email] = None
+                    self.skip_reasons[email] = 'Not a valid email'
+        pending = [email for email in pending if email not in verdicts]
+
+        owners = self.router and self.router.needs_contact_owner
+        found = {}
+        soql = "SELECT Id, Email, OwnerId FROM Contact WHERE Email IN (%s)" if owners else \
+            "SELECT Id, Email FROM Contact WHERE Email IN (%s)"
+        for query in self._in_queries(soql, pending):
+            for record in self._query_records(query):
+                found.setdefault(record['Email'].lower(), []).append(record['Id'])
+                if owners:
+                    self.contact_owners[record['Id']] = record['OwnerId']
+
+        for email in pending:
+            user_ids = found.get(email.lower(), [])
+            if len(user_ids) > 1:
+                logging.warning('Multiple contacts with same email %s.  Taking first record' % email)
+            verdicts[email] = user_ids[0] if user_ids else None
+            if not user_ids:
+                self.skip_reasons[email] = 'No user with that email'
+        self.saved_users.update(verdicts)
+        resolved.update(verdicts)
+        if self.lookup_cache and verdicts:
+            self.lookup_cache.set_many(verdicts)
+        if owners:
+            #Contacts that came from a cache still need their owner
+            self.prefetch_contact_owners(resolved.values())
+        return dict((email, resolved[email]) for email in emails)
     
     def get_ownerid_from_assigned_to_name(self, assignee):
         data = self.query("SELECT Id from User where Name='%s'" % assignee)
         return data['records'][0]['Id']
 
+    def buffer_api(self, calls=1):
+        '''Waits on the rate limiter before making calls Salesforce requests'''
+        waited = self.rate_limiter.acquire(calls)
+        self.stats.add_time('throttle', waited)
+        return waited
+
     @staticmethod
-    def buffer_api():
-        #max 20 per second 
-        time.sleep(0.05)
+    def _query_stage(soql):
+        '''Timer name for a query: api.query.<sobject>'''
+        match = re.search(r'\bfrom\s+(\w+)', soql, re.I)
+        return 'api.query.' + (match.group(1).lower() if match else 'other')
+
+    def _classify_error(self, error, idempotent=True):
+        '''(throttled, transient) for an exception from a Salesforce call'''
+        if isinstance(error, SalesforceRefusedRequest) and 'REQUEST_LIMIT_EXCEEDED' in repr(error.content):
+            return True, True
+        if isinstance(error, SalesforceGeneralError) and error.status in self.RETRY_STATUSES:
+            return error.status == 503, idempotent or error.status == 503
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return False, idempotent
+        return False, False
+
+    def _classify_create_error(self, error):
+        '''
+        (transient, unwritten) for a failed create. Only a refusal (503, REQUEST_LIMIT_EXCEEDED)
+        or another error answer from Salesforce proves nothing was saved; after a timeout,
+        connection error, 500, 502 or 504 the records may exist
+        '''
+        unwritten = self._classify_error(error, idempotent=False)[1]
+        transient = unwritten or self._classify_error(error)[1]
+        return transient, unwritten or (not transient and isinstance(error, SalesforceError))
+
+    def _forget_contact_tasks(self, user_id):
+        '''Drops user_id from searched_records so its Tasks are queried again before the next create'''
+        with self.dedupe_lock:
+            self.searched_records.pop(user_id)
+        self.stats.incr('tasks.uncertain')
+
+    def _call_with_retry(self, stage, call, idempotent=True):
+        '''
+        Runs call under the rate limiter and an in-flight slot, timed as stage.
+        Transient failures are retried with full-jitter exponential backoff
+        '''
+        self._ensure_login()
+        relogged = False
+        for attempt in itertools.count():
+            session_id = self.__dict__.get('session_id')
+            try:
+                with self.rate_control.slot():
+                    self.buffer_api()
+                    with self.stats.timed(stage):
+                        result = call()
+            except Exception as e:
+                exc_info = sys.exc_info()
+                if isinstance(e, SalesforceExpiredSession) and not relogged:
+                    #Requests carry the session in their headers, so call() picks up the new one
+                    self.relogin(session_id)
+                    relogged = True
+                    continue
+                throttled, transient = self._classify_error(e, idempotent)
+                if throttled and self.rate_control.on_throttle():
+                    self.stats.incr('api.throttled')
+                if not transient or attempt >= self.max_retries:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                logging.warning('%s failed (%s), retry %d in %.2fs' % (stage, e, attempt + 1, delay))
+                self.stats.incr('api.retries')
+                with self.stats.timed('backoff'):
+                    time.sleep(delay)
+            else:
+                self.rate_control.on_success()
+                return result
+
+    def query(self, query, **kwargs):
+        return self._call_with_retry(self._query_stage(query),
+            lambda: Salesforce.query(self, query, **kwargs))
+
+    def query_more(self, next_records_identifier, identifier_is_url=False, **kwargs):
+        return self._call_with_retry('api.query_more',
+            lambda: Salesforce.query_more(self, next_records_identifier, identifier_is_url, **kwargs))
+
+    def _call_salesforce(self, method, url, **kwargs):
+        return self._call_with_retry('api.' + url.rstrip('/').rsplit('/', 1)[-1],
+            lambda: Salesforce._call_salesforce(self, method, url, **kwargs), method == 'GET')
 
     def _save_activity_records(self, user_id):
-        '''Returns tasks for given user_id'''
-        data = self.query("SELECT WhoId, ActivityDate, Subject FROM Task WHERE WhoId = '%s' " % user_id)
-        self.searched_records[user_id] = data['records']
+        '''Loads and returns the task fingerprints for given user_id'''
+        data = self.query("SELECT WhoId, ActivityDate, Subject FROM Task WHERE WhoId = '%s' " % user_id +
+            self._activity_window())
+        records = set(self._task_key(record) for record in data['records'])
+        self.searched_records[user_id] = records
+        return records
+
+    def _activity_window(self):
+        '''
+        The export's days are in the project's time zone while ActivityDate is local,
+        so its first events may fall on the day before activity_since
+        '''
+        if not self.activity_since:
+            return ""
+        since = datetime.datetime.strptime(self.activity_since, '%Y-%m-%d') - datetime.timedelta(days=1)
+        return "AND ActivityDate >= %s" % since.strftime('%Y-%m-%d')
+
+    def prefetch_activity_records(self, user_ids):
+        '''
+        Loads existing Tasks for many WhoIds at once with WhoId IN (...) queries,
+        bounded by activity_since, into searched_records
+        '''
+        unique = set(user_id for user_id in user_ids if user_id)
+        pending = [user_id for user_id in unique if user_id not in self.searched_records]
+        self.stats.incr('cache.searched_records.hit', len(unique) - len(pending))
+        self.stats.incr('cache.searched_records.miss', len(pending))
+        found = dict((user_id, set()) for user_id in pending)
+        soql = "SELECT WhoId, ActivityDate, Subject FROM Task WHERE WhoId IN (%s) " + self._activity_window()
+        for query in self._in_queries(soql, pending):
+            for record in self._query_records(query):
+                found.setdefault(record['WhoId'], set()).add(self._task_key(record))
+        self.searched_records.update(found)
 
     def create_dupeless_task(self, task):
         '''
         Check that task does not already exist (first in memory then through API call),
         If not, create Salesforce task
         '''
-        user_id = task['WhoId']
-        if user_id not in self.searched_records:
-            self._save_activity_records(user_id)
-        for record in self.searched_records[user_id]:
-            compare_task_record = lambda item: \
-                str(task[item].encode('ascii', 'ignore')).strip() == str(record[item].encode('ascii', 'ignore')).strip()  
-            try:
-                if compare_task_record('ActivityDate') and compare_task_record('Subject'):
-                    raise CustomMPDataError("Task '%s' already created...skipping" % task['Subject'])
-            except KeyError:
-                pass
-            except AttributeError:
-                pass
+        self.check_duplicate_task(task)
         print task 
-        self.Task.create(task)
+        try:
+            self._call_with_retry('api.task_create', lambda: self.Task.create(task), idempotent=False)
+        except Exception:
+            exc_info = sys.exc_info()
+            if not self._classify_create_error(exc_info[1])[1]:
+                #It may have been saved, so a replay has to see it
+                self._forget_contact_tasks(task['WhoId'])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.stats.incr('tasks.created')
+        self._remember_task(task)
+        self._log_created_task(task)
+
+    @staticmethod
+    def _log_created_task(task):
         logging.info('Created task "%s" w date %s for user %s' % tuple([task[i] for i in "Subject", "ActivityDate", "WhoId"]))
 
+    def queue_task(self, task):
+        '''
+        Queues a deduplicated task for the next flush_tasks.
+        Flushes and returns its results once COLLECTION_SIZE tasks are waiting
+        '''
+        self.pending_tasks.append(task)
+        if len(self.pending_tasks) >= self.COLLECTION_SIZE:
+            return self.flush_tasks()
+        return []
+
+    def flush_tasks(self):
+        '''
+        Creates the queued tasks with sObject Collections requests of up to COLLECTION_SIZE records.
+        Returns one {'task', 'success', 'id', 'errors'} dict per task, in queue order
+        '''
+        tasks, self.pending_tasks = self.pending_tasks, []
+        return self._create_tasks(tasks)
+
+    def _create_tasks(self, tasks):
+        results = []
+        for i in range(0, len(tasks), self.COLLECTION_SIZE):
+            batch = tasks[i:i + self.COLLECTION_SIZE]
+            records = [dict(task, attributes={'type': 'Task'}) for task in batch]
+            try:
+                response = self._call_salesforce('POST', self.base_url + 'composite/sobjects',
+                    data=json.dumps({'allOrNone': False, 'records': records}))
+                saved_records = response.json()
+            except Exception as e:
+                transient, unwritten = self._classify_create_error(e)
+                if not unwritten:
+                    #Some of this group may have been saved; replays query its contacts' Tasks again
+                    for who_id in set(task['WhoId'] for task in batch):
+                        self._forget_contact_tasks(who_id)
+                if not transient:
+                    #Nothing after this group was sent, so a later run may create them
+                    exc_info = sys.exc_info()
+                    for task in tasks[i:]:
+                        self._forget_task(task)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                #Marked retry so callers queue the events again
+                saved_records = [{'success': False, 'retry': True, 'errors': [{'message': str(e)}]}] * len(batch)
+            for task, saved in zip(batch, saved_records):
+                result = {'task': task, 'success': saved['success'], 'retry': saved.get('retry', False),
+                          'id': saved.get('id'), 'errors': saved.get('errors', [])}
+                if result['success']:
+                    self.stats.incr('tasks.created')
+                    self._log_created_task(task)
+                else:
+                    self.stats.incr('tasks.failed')
+                    self._forget_task(task)
+                    logging.warning('Failed to create task "%s" w date %s for user %s: %s' %
+                        (task['Subject'], task['ActivityDate'], task['WhoId'],
+                         '; '.join(e.get('message', '') for e in result['errors'])))
+                results.append(result)
+        return results
+
+    def _queue_dupeless_task(self, task, queue):
+        with self.dedupe_lock:
+            self.check_duplicate_task(task)
+            #Remembered as soon as queued so a repeat in the same batch is a duplicate
+            self._remember_task(task)
+        queue.append(task)
+
+    def check_duplicate_task(self, task):
+        '''Raises CustomMPDataError if task already exists (first in memory then through API call)'''
+        user_id = task['WhoId']
+        records = self.searched_records.get(user_id)
+        if records is None:
+            self.stats.incr('cache.searched_records.miss')
+            records = self._save_activity_records(user_id)
+        else:
+            self.stats.incr('cache.searched_records.hit')
+        if self._task_key(task) in records:
+            raise DuplicateTaskError("Task '%s' already created...skipping" % task['Subject'])
+
+    @staticmethod
+    def _normalize(value):
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'ignore')
+        if isinstance(value, unicode):
+            return value.encode('ascii', 'ignore').strip()
+        return value
+
+    @classmethod
+    def _task_key(cls, task):
+        '''Dedupe fingerprint of a task or Task record within its WhoId: hash of ActivityDate and normalized Subject'''
+        return hash((cls._normalize(task.get("ActivityDate")), cls._normalize(task.get("Subject"))))
+
+    def forget_invalid_users(self):
+        '''
+        Drops the in-memory None verdicts of saved_users, so a long-lived instance looks up
+        again contacts created since; the lookup_cache keeps its own TTL for them
+        '''
+        self.stats.incr('cache.saved_users.expired', self.saved_users.discard_value(None))
+
+    def _remember_task(self, task):
+        self.searched_records.setdefault(task['WhoId'], set()).add(self._task_key(task))
+
+    def _forget_task(self, task):
+        with self.dedupe_lock:
+            self.searched_records.get(task['WhoId'], set()).discard(self._task_key(task))
+
     def check_email_and_get_id(self, email):
         '''Checks if id is an email, then if email exists in SFDC instance, then returns first'''
+        user_id = self.saved_users.get(email)
+        if user_id:
+            return user_id
         if not validate_email(email):
             raise CustomMPDataError('Not a valid email') 
         user_ids = self._get_user_ids(email)
@@ -138,26 +609,121 @@ class SalesforceApi(Salesforce):
         self.saved_users[email]= user_ids[0]
         return user_ids[0]
 
+    def coalesce_events(self, events, aggregate=False):
+        '''
+        Yields one event per (distinct_id, day, subject) group, in order of each group's first event.
+        Groups are released once a later day starts, so time-ordered input is held for at most a day.
+        With aggregate, a group's event gets coalesced_count, first_time and last_time properties,
+        which end up in the task Description.
+        '''
+        groups, group_day = collections.OrderedDict(), None
+        for event in events:
+            try:
+                properties = event['properties']
+                day = self.convert_time_stamp_to_sf_date_format(properties['time'])
+                key = (properties['distinct_id'], day, self.get_sf_task_subject(event['event'], properties))
+            except (KeyError, TypeError, ValueError):
+                #Let the task path log what is wrong with it
+                yield event
+                continue
+            if group_day is not None and day > group_day:
+                for group in self._release_groups(groups, aggregate):
+                    yield group
+            group_day = max(day, group_day)
+            if key in groups:
+                groups[key][1].append(properties['time'])
+                self.stats.incr('coalesced')
+            else:
+                groups[key] = (event, [properties['time']])
+        for group in self._release_groups(groups, aggregate):
+            yield group
+
+    @staticmethod
+    def _release_groups(groups, aggregate):
+        while groups:
+            event, times = groups.popitem(last=False)[1]
+            if aggregate and len(times) > 1:
+                event = dict(event, properties=dict(event['properties'], coalesced_count=len(times),
+                                                    first_time=min(times), last_time=max(times)))
+            yield event
+
     def create_sfdc_task_from_mp_object(self, event, **kwargs):
         '''
         Creates a new task, if possible (and desirable, through Salesforce API
         Else logs reason why not 
         '''
-        self.buffer_api()
+        return self._handle_mp_object(event, self.create_dupeless_task)
+
+    def _handle_mp_object(self, event, save):
+        '''Converts event to a task and passes it to save, logging why not on bad data'''
         try:
             try:
                 #Create task from object and id lookup 
                 task = self.event_to_salesforce_task_object(event)
                 #Save task:
-                self.create_dupeless_task(task)
+                save(task)
                 return True 
             except CustomMPDataError as e:
                 id_ = event['properties']['distinct_id']
-                self.saved_users[id_] = None
+                #A duplicate says nothing about the contact; its other tasks still go through
+                if not isinstance(e, DuplicateTaskError):
+                    self.saved_users[id_] = None
+                    self.skip_reasons[id_] = str(e)
+                self.stats.incr('skip.' + ('duplicate task' if isinstance(e, DuplicateTaskError) else str(e)))
                 logging.info('User %s; Error: %s' % (id_, str(e)))
+            except (SalesforceError, requests.exceptions.RequestException) as e:
+                if not self._classify_error(e)[1]:
+                    raise
+                self._queue_retry(event, e)
         except KeyError as e:
+            self.stats.incr('skip.bad event')
             logging.info('Problem %s with mixpanel event %s' % (str(e), str(event) )) 
 
+    def create_sfdc_tasks_from_mp_objects(self, events):
+        '''
+        Creates tasks for a batch of events, resolving all their contacts and existing Tasks
+        up front with resolve_emails and prefetch_activity_records, and saving them in bulk.
+        Safe to call from several threads as long as each user's events go to one of them.
+        Returns a list of results in event order: True if created, else None
+        '''
+        emails = [e['properties']['distinct_id'] for e in events if isinstance(e, dict) and
+                  isinstance(e.get('properties', {}).get('distinct_id'), basestring)]
+        results, queued, tasks = [None] * len(events), [], []
+        try:
+            self.prefetch_activity_records(self.resolve_emails(emails).values())
+        except (SalesforceError, requests.exceptions.RequestException) as e:
+            if not self._classify_error(e)[1]:
+                raise
+            for event in events:
+                self._queue_retry(event, e)
+            return results
+
+        try:
+            for index, event in enumerate(events):
+                if self._handle_mp_object(event, lambda task: self._queue_dupeless_task(task, tasks)):
+                    queued.append(index)
+        except Exception:
+            #The queued tasks were remembered but never sent
+            exc_info = sys.exc_info()
+            for task in tasks:
+                self._forget_task(task)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        for index, result in zip(queued, self._create_tasks(tasks)):
+            results[index] = result['success'] or None
+            if result['retry']:
+                self._queue_retry(events[index], result['errors'][0]['message'])
+        return results
+
+    def _queue_retry(self, event, error):
+        self.retry_queue.append(event)
+        self.stats.incr('retry.queued')
+        logging.warning('Queued event %s for retry after: %s' % (str(event), error))
+
+    def drain_retry_queue(self):
+        '''Returns and clears the events queued for retry'''
+        events, self.retry_queue = self.retry_queue, []
+        return events
+
 
 
 
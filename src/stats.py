@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections, contextlib, json, resource, threading, time
+
+
+class RunStats(object):
+
+    '''
+    Thread-safe counters and per-stage timers for one run.
+    Timer names are stages or API call types (e.g. 'api.query.contact'); counters
+    hold cache hits/misses and skip reasons. summary() is the JSON run report.
+    '''
+
+    def __init__(self, clock=time.time):
+        self.counters = collections.Counter()
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.started = clock()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            self.seconds[name] += seconds
+            self.calls[name] += calls
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, self._clock() - start)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'wall_seconds': round(self._clock() - self.started, 3),
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'counters': dict(self.counters),
+                'stages': dict((name, {'seconds': round(self.seconds[name], 4), 'calls': self.calls[name]})
+                               for name in self.seconds),
+            }
+
+    def write_json(self, path, **extra):
+        '''Writes summary(), plus any extra top-level keys, to path'''
+        with open(path, 'w') as f:
+            json.dump(dict(self.summary(), **extra), f, indent=2, sort_keys=True)
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+#
+#
+# Api Client for Mixpanel/Salesforce integration
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections, itertools, json, logging, sys
+import Queue
+from multiprocessing.pool import ThreadPool
+
+
+#Keys every tenant in the config file needs, and defaults for the rest
+REQUIRED_KEYS = ('name', 'mp_api_key', 'mp_api_secret', 'username', 'password', 'security_token',
+                 'events', 'subject_components', 'assigned_to')
+DEFAULTS = {'sandbox': False, 'task_status': 'Completed', 'api_rate': 20, 'api_burst': 20, 'checkpoint': None,
+            'owner_rules': None, 'api_max_rate': None}
+
+
+def load_tenants(path):
+    '''
+    Reads a JSON file of the form {"tenants": [{...}, ...]}, one entry per
+    Mixpanel project -> Salesforce org job. Raises ValueError on a missing key or duplicate name
+    '''
+    with open(path) as f:
+        entries = json.load(f)['tenants']
+    tenants, names = [], set()
+    for index, entry in enumerate(entries):
+        missing = [key for key in REQUIRED_KEYS if key not in entry]
+        if missing:
+            raise ValueError('Tenant %s in %s is missing %s' % (entry.get('name', index), path, ', '.join(missing)))
+        if entry['name'] in names:
+            raise ValueError('Tenant name %s is used twice in %s' % (entry['name'], path))
+        names.add(entry['name'])
+        tenant = dict(DEFAULTS)
+        tenant.update(entry)
+        #The adaptive rate may not climb past the tenant's own limit unless told to
+        if tenant['api_max_rate'] is None:
+            tenant['api_max_rate'] = tenant['api_rate']
+        tenants.append(tenant)
+    return tenants
+
+
+class Tenant(object):
+
+    '''One job: a lazy iterator of its events, the SalesforceApi writing them and its own RunStats'''
+
+    def __init__(self, name, salesforce_api, events, stats, checkpoint=None):
+        self.name = name
+        self.salesforce_api = salesforce_api
+        self.events = iter(events)
+        self.stats = stats
+        self.checkpoint = checkpoint
+        #Set when the tenant failed and was dropped from the run
+        self.error = None
+
+
+class FairScheduler(object):
+
+    '''
+    Runs many tenants on one pool of worker threads, round-robin: a worker reads and syncs
+    one batch of a tenant, which then goes to the back of the line. A tenant never has
+    two batches in flight, so its events stay in order and a big tenant gets the same
+    turns as a small one. A tenant that raises is logged and dropped; the others carry on.
+    '''
+
+    def __init__(self, tenants, workers=4, batch_size=200):
+        self.tenants = tenants
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def run(self):
+        '''Yields (tenant, events, results) for each batch as it completes'''
+        ready, done = collections.deque(self.tenants), Queue.Queue()
+        pool = ThreadPool(self.workers)
+        in_flight = 0
+        try:
+            while ready or in_flight:
+                while ready and in_flight < self.workers:
+                    pool.apply_async(self._step, (ready.popleft(), done))
+                    in_flight += 1
+                tenant, batch, results, error = done.get()
+                in_flight -= 1
+                if error:
+                    tenant.error = error[1]
+                    tenant.stats.incr('tenant.failed')
+                    logging.error('Tenant %s failed and was dropped' % tenant.name, exc_info=error)
+                    continue
+                if batch:
+                    ready.append(tenant)
+                    yield tenant, batch, results
+        finally:
+            pool.terminate()
+
+    def _step(self, tenant, done):
+        try:
+            batch = list(itertools.islice(tenant.events, self.batch_size))
+            results = tenant.salesforce_api.create_sfdc_tasks_from_mp_objects(batch) if batch else []
+        except Exception:
+            done.put((tenant, [], [], sys.exc_info()))
+        else:
+            done.put((tenant, batch, results, None))
@@ -5,6 +5,15 @@ from src.salesforce_mp_zap import *
 import unittest
 
 from tests.salesforce_mp_zap import *
+from tests.mixpanel_api import *
+from tests.lookup_cache import *
+from tests.checkpoint import *
+from tests.pipeline import *
+from tests.event_store import *
+from tests.benchmark import *
+from tests.stats import *
+from tests.tenants import *
+from tests.routing import *
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,33 @@
+import sys
+sys.path.append('..')
+
+from bench.generate import generate
+from bench.run import run
+
+import unittest
+import os
+import tempfile
+
+
+class BenchSmokeTestCase(unittest.TestCase):
+
+    '''Runs the offline benchmark end to end on a small export'''
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        self.contacts, self.tasks = generate(self.path, events = 400, users = 40, event_names = ['Report Preview Clicked'])
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_report(self):
+        report = run(self.path, self.contacts)
+        self.assertEquals(report['events'], 400)
+        self.assertEquals(report['tasks_created'], self.tasks)
+        self.assertTrue(report['api_calls_per_event'] < 0.1)
+        self.assertEquals(report['api_calls_by_endpoint'].get('create'), None)
+
+    def test_export_layout(self):
+        with open(self.path) as f:
+            self.assertTrue(f.readline().startswith('{"event":"Report Preview Clicked",'))
@@ -0,0 +1,71 @@
+import sys
+sys.path.append('..')
+
+from src.checkpoint import Checkpoint
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+
+
+def event(t, name = 'Purchase Item'):
+    return {'event': name, 'properties': {'time': t, 'distinct_id': 'test@test.com'}}
+
+
+class CheckpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_without_checkpoint_everything_is_new(self):
+        checkpoint = Checkpoint(self.path)
+        self.assertEquals(checkpoint.from_date(), None)
+        self.assertTrue(checkpoint.is_new(event(1)))
+
+    def test_resume_skips_processed_events(self):
+        '''Events up to the committed mark, including the boundary, are skipped'''
+        checkpoint = Checkpoint(self.path)
+        checkpoint.advance([event(1), event(2), event(2, 'Other')])
+        checkpoint.commit()
+
+        resumed = Checkpoint(self.path)
+        self.assertFalse(resumed.is_new(event(1)))
+        self.assertFalse(resumed.is_new(event(2)))
+        self.assertFalse(resumed.is_new(event(2, 'Other')))
+        self.assertTrue(resumed.is_new(event(2, 'Third')))
+        self.assertTrue(resumed.is_new(event(3)))
+
+    def test_from_date_overlaps_a_day(self):
+        '''The export may date the mark's events a day earlier in the project's time zone'''
+        mark = time.mktime((2015, 3, 18, 12, 0, 0, 0, 0, -1))
+        checkpoint = Checkpoint(self.path)
+        checkpoint.advance([event(mark)])
+        checkpoint.rebase()
+        self.assertEquals(checkpoint.from_date(), '2015-03-17')
+
+    def test_uncommitted_progress_is_lost(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.advance([event(1)])
+        checkpoint.commit()
+        checkpoint.advance([event(5)])
+        self.assertTrue(Checkpoint(self.path).is_new(event(5)))
+
+    def test_filter_uses_starting_mark(self):
+        '''Advancing during a run should not hide later events of the same run'''
+        checkpoint = Checkpoint(self.path)
+        checkpoint.advance([event(5)])
+        self.assertTrue(checkpoint.is_new(event(4)))
+
+    def test_rebase_starts_next_pass_from_mark(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.advance([event(5), event(5, 'Other')])
+        checkpoint.rebase()
+        self.assertFalse(checkpoint.is_new(event(4)))
+        self.assertFalse(checkpoint.is_new(event(5, 'Other')))
+        self.assertTrue(checkpoint.is_new(event(5, 'New')))
@@ -0,0 +1,44 @@
+import sys
+sys.path.append('..')
+
+from src.event_store import EventStore
+
+import unittest
+import os
+import tempfile
+
+
+def event(t, name = 'Purchase Item', user = 'test@test.com'):
+    return {'event': name, 'properties': {'time': t, 'distinct_id': user}}
+
+
+class EventStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.store = EventStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self.path)
+
+    def test_upsert_is_idempotent(self):
+        events = [event(2), event(1), event(1, 'Other')]
+        self.store.upsert(events)
+        self.store.upsert(events)
+        self.assertEquals(list(self.store.query()), [event(1), event(1, 'Other'), event(2)])
+
+    def test_query_by_event_and_time(self):
+        self.store.upsert([event(t, name) for t in range(5) for name in ('A', 'B')])
+        self.assertEquals([(e['event'], e['properties']['time']) for e in self.store.query(['A'], 1, 3)],
+            [('A', 1), ('A', 2), ('A', 3)])
+
+    def test_query_by_distinct_id(self):
+        self.store.upsert([event(1, user = 'a@test.com'), event(2, user = 'b@test.com')])
+        self.assertEquals(list(self.store.query(distinct_id = 'b@test.com')), [event(2, user = 'b@test.com')])
+
+    def test_store_passes_events_through(self):
+        events = [event(t) for t in range(5)]
+        self.assertEquals(list(self.store.store(iter(events), batch_size = 2)), events)
+        self.assertEquals(len(list(self.store.query())), 5)
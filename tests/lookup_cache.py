@@ -0,0 +1,47 @@
+import sys
+sys.path.append('..')
+
+from src.lookup_cache import LookupCache
+
+import unittest
+import os
+import tempfile
+
+
+class LookupCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [1000.0]
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.cache = LookupCache(self.path, ttl=100, negative_ttl=10, clock=lambda: self.now[0])
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.path)
+
+    def test_round_trip_is_case_insensitive(self):
+        self.cache.set_many({'A@test.com': 'A', 'b@test.com': None})
+        self.assertEquals(self.cache.get_many(['a@test.com', 'b@test.com', 'c@test.com']),
+            {'a@test.com': 'A', 'b@test.com': None})
+
+    def test_negative_entries_expire_first(self):
+        self.cache.set_many({'a@test.com': 'A', 'b@test.com': None})
+        self.now[0] += 50
+        self.assertEquals(self.cache.get_many(['a@test.com', 'b@test.com']), {'a@test.com': 'A'})
+        self.now[0] += 100
+        self.assertEquals(self.cache.get_many(['a@test.com']), {})
+
+    def test_shared_between_instances(self):
+        '''A second run should see the first run's lookups'''
+        self.cache.set_many({'a@test.com': 'A'})
+        other = LookupCache(self.path, clock=lambda: self.now[0])
+        self.assertEquals(other.get_many(['a@test.com']), {'a@test.com': 'A'})
+        other.invalidate(['a@test.com'])
+        other.close()
+        self.assertEquals(self.cache.get_many(['a@test.com']), {})
+
+    def test_invalidate_all(self):
+        self.cache.set_many({'a@test.com': 'A', 'b@test.com': 'B'})
+        self.cache.invalidate()
+        self.assertEquals(self.cache.get_many(['a@test.com', 'b@test.com']), {})
@@ -0,0 +1,251 @@
+import sys
+sys.path.append('..')
+
+from src.mixpanel_api import Mixpanel, make_session, split_ranges
+
+import unittest
+import json
+import csv
+import codecs
+import os
+import tempfile
+
+from mock import patch, Mock
+
+
+class FakeResponse(object):
+
+    '''Streamed requests response serving body in small chunks'''
+
+    def __init__(self, body, status_code = 200):
+        self.body, self.status_code, self.closed = body, status_code, False
+        self.content = body
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), 7):
+            yield self.body[i:i + 7]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError(self.status_code)
+
+    def close(self):
+        self.closed = True
+
+
+def fake_session(*bodies):
+    session = Mock()
+    session.get.side_effect = [FakeResponse(body) for body in bodies]
+    return session
+
+
+class StreamingExportTestCase(unittest.TestCase):
+
+    events = [
+        {"event": "Report Preview Clicked", "properties": {"time": 1426700933, "distinct_id": "test@test.com"}},
+        {"event": "Page Viewed", "properties": {"time": 1426700934, "distinct_id": "test@test.com"}},
+        {"event": "Report Preview Clicked", "properties": {"time": 1426700935, "distinct_id": "other@test.com"}},
+    ]
+
+    def setUp(self):
+        self.body = ''.join(json.dumps(e) + '\n' for e in self.events)
+        self.mixpanel = Mixpanel(api_key = 'key', api_secret = 'secret')
+
+    def open_stream(self):
+        self.mixpanel.session = fake_session(self.body)
+        self.mixpanel.request(['export'], {'from_date': '2015-03-18', 'to_date': '2015-03-18'}, stream=True)
+
+    def test_stream_does_not_buffer_data(self):
+        '''Streaming request should keep the response open instead of reading it'''
+        self.open_stream()
+        self.assertEquals(self.mixpanel.data, None)
+        self.assertNotEquals(self.mixpanel.stream, None)
+
+    def test_stream_reassembles_lines_across_chunks(self):
+        '''Lines split over chunk boundaries should still parse'''
+        self.open_stream()
+        self.assertEquals(list(self.mixpanel.iter_events()), self.events)
+
+    def test_stream_filters_events(self):
+        self.open_stream()
+        events = self.mixpanel.generate_salesforce_task_objects_by_event_type(['Report Preview Clicked'])
+        self.assertEquals([e['properties']['time'] for e in events], [1426700933, 1426700935])
+
+    def test_buffered_request_still_sets_data(self):
+        self.mixpanel.session = fake_session(self.body)
+        self.mixpanel.request(['export'], {})
+        self.assertEquals(self.mixpanel.data, self.body)
+        self.assertEquals(list(self.mixpanel.iter_events()), self.events)
+
+
+class ShardedExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mixpanel = Mixpanel(api_key = 'key', api_secret = 'secret')
+        self.opened, self.failures = [], {'2015-03-02': 1}
+
+    def fake_open(self, methods, params, format):
+        '''One event per day; 2015-03-02 fails once'''
+        self.opened.append(dict(params))
+        day = params['from_date']
+        if self.failures.get(day):
+            self.failures[day] -= 1
+            raise IOError('timeout')
+        return FakeResponse(json.dumps({'event': 'E', 'properties': {'day': day}}) + '\n')
+
+    def test_shards_are_fetched_separately_and_in_order(self):
+        with patch.object(Mixpanel, '_open', side_effect = self.fake_open):
+            with patch('src.mixpanel_api.time.sleep'):
+                self.mixpanel.request_shards(['export'], {'from_date': '2015-03-01', 'to_date': '2015-03-04'},
+                    max_in_flight = 3)
+                days = [e['properties']['day'] for e in self.mixpanel.iter_events()]
+        self.assertEquals(days, ['2015-03-01', '2015-03-02', '2015-03-03', '2015-03-04'])
+        #Four shards plus one retry of the failed one
+        self.assertEquals(len(self.opened), 5)
+        self.assertTrue(all(p['from_date'] == p['to_date'] for p in self.opened))
+
+    def test_shard_size(self):
+        with patch.object(Mixpanel, '_open', side_effect = self.fake_open):
+            with patch('src.mixpanel_api.time.sleep'):
+                self.mixpanel.request_shards(['export'], {'from_date': '2015-03-01', 'to_date': '2015-03-05'},
+                    days_per_shard = 2)
+                list(self.mixpanel.iter_events())
+        self.assertEquals(sorted(set((p['from_date'], p['to_date']) for p in self.opened)),
+            [('2015-03-01', '2015-03-02'), ('2015-03-03', '2015-03-04'), ('2015-03-05', '2015-03-05')])
+
+    def test_each_shard_is_signed(self):
+        self.mixpanel.session = fake_session('', '')
+        self.mixpanel.request_shards(['export'], {'from_date': '2015-03-01', 'to_date': '2015-03-02'})
+        list(self.mixpanel.iter_events())
+        urls = [c[0][0] for c in self.mixpanel.session.get.call_args_list]
+        self.assertEquals(len(urls), 2)
+        self.assertTrue(all('sig=' in url and 'expire=' in url for url in urls))
+        self.assertNotEquals(urls[0], urls[1])
+
+    def test_shard_gives_up_after_retries(self):
+        self.failures['2015-03-02'] = 5
+        with patch.object(Mixpanel, '_open', side_effect = self.fake_open):
+            with patch('src.mixpanel_api.time.sleep'):
+                self.mixpanel.request_shards(['export'], {'from_date': '2015-03-02', 'to_date': '2015-03-02'},
+                    retries = 2)
+                self.assertRaises(IOError, list, self.mixpanel.iter_events())
+
+
+class EventPrefilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mixpanel = Mixpanel(api_key = 'key', api_secret = 'secret')
+
+    def test_untracked_lines_are_not_decoded(self):
+        self.mixpanel.data = '\n'.join([
+            '{"event":"Report Preview","properties":{}}',
+            '{"event":"Report","properties":{}}',
+            '{"event":"Ignored", this is not json',
+        ]) + '\n'
+        events = list(self.mixpanel.iter_events(['Report']))
+        self.assertEquals(events, [{'event': 'Report', 'properties': {}}])
+
+    def test_non_ascii_names_match_either_spelling(self):
+        name = u'Caf\xe9 Visited'
+        self.mixpanel.data = '\n'.join([
+            json.dumps({'event': name, 'properties': {}}),
+            '{"event":"%s","properties":{}}' % name.encode('utf-8'),
+        ])
+        self.assertEquals(len(list(self.mixpanel.iter_events([name.encode('utf-8')]))), 2)
+
+    def test_unexpected_layout_falls_back_to_json(self):
+        self.mixpanel.data = '{"properties": {}, "event": "Report"}\n'
+        self.assertEquals(len(list(self.mixpanel.iter_events(['Report']))), 1)
+
+    def test_event_filter_sent_to_server(self):
+        self.mixpanel.session = fake_session('')
+        self.mixpanel.request(['export'], {'event': ['Report']})
+        self.assertIn('event=%5B%22Report%22%5D', self.mixpanel.session.get.call_args[0][0])
+
+
+class ExportCsvTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mixpanel = Mixpanel(api_key = 'key', api_secret = 'secret')
+        self.mixpanel.data = '\n'.join([
+            json.dumps({'event': 'A', 'properties': {'x': 1, 'name': u'Caf\xe9'}}),
+            json.dumps({'event': 'B', 'properties': {'y': 'two'}}),
+        ]) + '\n'
+        self.outfile = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.outfile):
+            os.remove(self.outfile)
+
+    def read_rows(self):
+        with open(self.outfile) as f:
+            self.assertEquals(f.read(3), codecs.BOM_UTF8)
+            return list(csv.reader(f))
+
+    def test_header_is_union_of_properties(self):
+        self.mixpanel.export_csv(outfileName = self.outfile)
+        self.assertEquals(self.read_rows(), [
+            ['event', 'property_name', 'property_x', 'property_y'],
+            ['A', 'Caf\xc3\xa9', '1', ''],
+            ['B', '', '', 'two'],
+        ])
+
+    def test_fixed_columns_single_pass(self):
+        with patch('src.mixpanel_api.marshal.dump') as mock_spool:
+            self.mixpanel.export_csv(columns = ['y'], outfileName = self.outfile)
+            self.assertFalse(mock_spool.called)
+        self.assertEquals(self.read_rows(), [['event', 'property_y'], ['A', ''], ['B', 'two']])
+
+
+class ParallelParseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            for i in range(300):
+                f.write('{"event":"%s","properties":{"time":%d}}\n' % ('Report' if i % 3 else 'Other', i))
+        self.mixpanel = Mixpanel(api_key = 'key', api_secret = 'secret')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_ranges_cover_file_on_line_boundaries(self):
+        ranges = split_ranges(self.path, 1000)
+        self.assertGreater(len(ranges), 1)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.assertEquals(''.join(data[start:end] for start, end in ranges), data)
+        for start, end in ranges:
+            self.assertEquals(data[end - 1], '\n')
+
+    def test_matches_serial_parse_in_order(self):
+        self.mixpanel.load_file(self.path)
+        serial = list(self.mixpanel.iter_events(['Report']))
+        self.mixpanel.RANGE_SIZE = 1000
+        self.mixpanel.load_file(self.path, processes = 2)
+        self.assertEquals(list(self.mixpanel.iter_events(['Report'])), serial)
+        self.assertEquals(len(serial), 200)
+        #100 skipped by each parse
+        self.assertEquals(self.mixpanel.stats.summary()['counters']['export.prefiltered'], 200)
+
+
+class HttpSessionTestCase(unittest.TestCase):
+
+    def test_streamed_request_uses_session_with_timeout(self):
+        mixpanel = Mixpanel(api_key = 'key', api_secret = 'secret', session = fake_session(''), timeout = (1, 2))
+        mixpanel.request(['export'], {}, stream=True)
+        self.assertEquals(mixpanel.session.get.call_args[1], {'stream': True, 'timeout': (1, 2)})
+
+    def test_error_status_raises(self):
+        session = Mock()
+        session.get.return_value = FakeResponse('', status_code = 503)
+        mixpanel = Mixpanel(api_key = 'key', api_secret = 'secret', session = session)
+        self.assertRaises(IOError, mixpanel.request, ['export'], {})
+
+    def test_make_session_pools_and_retries(self):
+        session = make_session(pool_size = 8, retries = 2)
+        adapter = session.get_adapter('http://data.mixpanel.com/api')
+        self.assertEquals(adapter._pool_maxsize, 8)
+        self.assertEquals(adapter.max_retries.total, 2)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+        self.assertIn('gzip', session.headers['Accept-Encoding'])
@@ -0,0 +1,105 @@
+import sys
+sys.path.append('..')
+
+from src.pipeline import SyncPipeline
+from src import gevent_pipeline
+
+import unittest
+import itertools
+import threading
+import time
+
+
+class FakeSalesforceApi(object):
+
+    def __init__(self, fail_on = None):
+        self.fail_on = fail_on
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def create_sfdc_tasks_from_mp_objects(self, events):
+        results = []
+        for event in events:
+            user = event['properties']['distinct_id']
+            if user == self.fail_on:
+                raise ValueError(user)
+            with self.lock:
+                self.threads.setdefault(user.lower(), set()).add(threading.current_thread().name)
+            results.append(event['properties']['time'])
+        return results
+
+
+def events(n, users = 7):
+    return [{'event': 'Purchase Item', 'properties': {'time': i,
+        'distinct_id': ('User%d@test.com' if i % 2 else 'user%d@test.com') % (i % users)}} for i in range(n)]
+
+
+class SyncPipelineTestCase(unittest.TestCase):
+
+    def test_results_in_input_order(self):
+        stream = events(500)
+        pipeline = SyncPipeline(FakeSalesforceApi(), workers = 4, batch_size = 16, linger = 0.001)
+        results = list(pipeline.run(iter(stream)))
+        self.assertEquals([event for event, result in results], stream)
+        self.assertEquals([result for event, result in results], range(500))
+
+    def test_each_user_handled_by_one_worker(self):
+        '''Same user (any email case) should never be split across workers'''
+        api = FakeSalesforceApi()
+        list(SyncPipeline(api, workers = 4, batch_size = 8, linger = 0.001).run(iter(events(200))))
+        for user, threads in api.threads.items():
+            self.assertEquals(len(threads), 1)
+
+    def test_empty_input(self):
+        self.assertEquals(list(SyncPipeline(FakeSalesforceApi(), workers = 2).run(iter([]))), [])
+
+    def test_worker_errors_propagate(self):
+        pipeline = SyncPipeline(FakeSalesforceApi(fail_on = 'user2@test.com'), workers = 2, linger = 0.001)
+        self.assertRaises(ValueError, list, pipeline.run(iter(events(10))))
+
+    def wait_for_threads(self, count):
+        deadline = time.time() + 2
+        while threading.active_count() > count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(threading.active_count(), count)
+
+    def test_worker_error_stops_feeder(self):
+        '''The feeder should not stay blocked on a full inbox once a worker fails'''
+        before = threading.active_count()
+        pipeline = SyncPipeline(FakeSalesforceApi(fail_on = 'user2@test.com'), workers = 2, batch_size = 4, linger = 0.001)
+        self.assertRaises(ValueError, list, pipeline.run(itertools.cycle(events(10))))
+        self.wait_for_threads(before)
+
+    def test_closing_results_stops_threads(self):
+        before = threading.active_count()
+        results = SyncPipeline(FakeSalesforceApi(), workers = 2, batch_size = 4, linger = 0.001).run(itertools.cycle(events(10)))
+        next(results)
+        results.close()
+        self.wait_for_threads(before)
+
+
+class SlowSalesforceApi(FakeSalesforceApi):
+
+    def create_sfdc_tasks_from_mp_objects(self, events):
+        gevent_pipeline.gevent.sleep(0.05)
+        return super(SlowSalesforceApi, self).create_sfdc_tasks_from_mp_objects(events)
+
+
+@unittest.skipIf(gevent_pipeline.gevent is None, 'gevent not installed')
+class GeventPipelineTestCase(unittest.TestCase):
+
+    def test_matches_threaded_results(self):
+        stream = events(500)
+        threaded = list(SyncPipeline(FakeSalesforceApi(), workers = 4, batch_size = 16, linger = 0.001).run(iter(stream)))
+        pipeline = gevent_pipeline.GeventPipeline(FakeSalesforceApi(), concurrency = 50, batch_size = 16, linger = 0.001)
+        self.assertEquals(list(pipeline.run(iter(stream))), threaded)
+
+    def test_lanes_run_concurrently(self):
+        api = SlowSalesforceApi()
+        started = time.time()
+        list(gevent_pipeline.GeventPipeline(api, concurrency = 50, batch_size = 1, linger = 0.001).run(iter(events(50, users = 50))))
+        self.assertLess(time.time() - started, 1.0)
+
+    def test_worker_errors_propagate(self):
+        pipeline = gevent_pipeline.GeventPipeline(FakeSalesforceApi(fail_on = 'user2@test.com'), concurrency = 2, linger = 0.001)
+        self.assertRaises(ValueError, list, pipeline.run(iter(events(10))))
@@ -0,0 +1,34 @@
+import sys
+sys.path.append('..')
+
+from src.routing import OwnerRouter
+
+import unittest
+
+
+class OwnerRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.router = OwnerRouter([
+            {'event': 'Purchase Item', 'property': 'mp_country_code', 'values': ['DE', 'AT'], 'owner': 'Hans'},
+            {'event': ['Purchase Item', 'Refund'], 'owner': 'Jane'},
+            {'property': 'plan', 'values': ['enterprise'], 'contact_owner': True},
+        ])
+
+    def test_first_matching_rule_wins(self):
+        self.assertEquals(self.router.match('Purchase Item', {'mp_country_code': 'DE'})['owner'], 'Hans')
+        self.assertEquals(self.router.match('Purchase Item', {'mp_country_code': 'US'})['owner'], 'Jane')
+        self.assertEquals(self.router.match('Refund', {})['owner'], 'Jane')
+        self.assertTrue(self.router.match('Report', {'plan': 'enterprise'})['contact_owner'])
+        self.assertEquals(self.router.match('Report', {'plan': 'free'}), None)
+
+    def test_names_to_preload(self):
+        self.assertEquals(self.router.owner_names, set(['Hans', 'Jane']))
+        self.assertTrue(self.router.needs_contact_owner)
+        self.assertFalse(OwnerRouter([{'owner': 'Jane'}]).needs_contact_owner)
+
+    def test_invalid_rules_are_rejected(self):
+        self.assertRaises(ValueError, OwnerRouter, [{'event': 'Refund'}])
+        self.assertRaises(ValueError, OwnerRouter, [{'owner': 'Jane', 'contact_owner': True}])
+        self.assertRaises(ValueError, OwnerRouter, [{'property': 'plan', 'owner': 'Jane'}])
+        self.assertRaises(ValueError, OwnerRouter, [{'events': 'Refund', 'owner': 'Jane'}])
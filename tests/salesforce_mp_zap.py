@@ -1,10 +1,15 @@
 import unittest
 import time
+import requests
 
-from mock import patch
+from mock import patch, Mock
 
 from simple_salesforce import Salesforce, SFType
 from . import SalesforceApi, CustomMPDataError
+from src.rate_limiter import TokenBucket, AdaptiveRate
+from src.routing import OwnerRouter
+from simple_salesforce.api import SalesforceGeneralError, SalesforceRefusedRequest, SalesforceMalformedRequest, \
+    SalesforceExpiredSession
 
 
 class ValidTestCase(unittest.TestCase):
@@ -85,15 +90,16 @@ class ValidTestCase(unittest.TestCase):
             mock_query.assert_called_once()
             self.assertEquals(return_ids, user_ids) 
             self.sf_api._save_activity_records(user_ids[0])
-            self.assertEquals(self.sf_api.searched_records[user_ids[0]], mock_query.return_value['records'])
+            self.assertEquals(self.sf_api.searched_records[user_ids[0]],
+                set(SalesforceApi._task_key(r) for r in mock_query.return_value['records']))
 
-    def test_api_buffer_is_called_on_creating_task(self):
-        '''Buffer should be called'''
+    def test_api_buffer_is_called_on_query(self):
+        '''Buffer should be called before each Salesforce call'''
         class CustomException(Exception):
             pass
         with patch.object(SalesforceApi, 'buffer_api', side_effect = CustomException('test')) as mock_sleep:
             mock_sleep.assert_called_once()
-            self.assertRaises(CustomException, self.sf_api.create_sfdc_task_from_mp_object, '')
+            self.assertRaises(CustomException, self.sf_api.query, 'SELECT Id FROM Contact')
 
     def test_throttling_prev_on_creating_task(self):
         '''Shoulds save user as Nonetype, interrupt, and log on CustomMPDataError from event_to_salesforce_task_object'''
@@ -106,7 +112,7 @@ class ValidTestCase(unittest.TestCase):
     def test_create_dupless_task_searched_records_dupe(self):
         '''Should not lookup or save task if already searched  but raises CustomMPDataError'''
         with patch.object(SalesforceApi, '_save_activity_records') as mock_save:
-            self.sf_api.searched_records[self.sf_ob_should_be['WhoId']] = [self.sf_ob_should_be]
+            self.sf_api.searched_records[self.sf_ob_should_be['WhoId']] = set([SalesforceApi._task_key(self.sf_ob_should_be)])
             self.assertRaises( CustomMPDataError, self.sf_api.create_dupeless_task, self.sf_ob_should_be)
             assert not mock_save.called
 
@@ -178,3 +184,606 @@ class InvalidTestCases(unittest.TestCase):
 
 
 
+
+
+def make_sf_api(**kwargs):
+    '''SalesforceApi with login and owner lookup patched out'''
+    with patch.object(Salesforce, '__init__', return_value = None):
+        with patch.object(SalesforceApi, 'get_ownerid_from_assigned_to_name', return_value = 'Owner Id'):
+            sf_api = SalesforceApi(subject_components = [], task_status = 'Completed',
+                assigned_to = 'Owner', **kwargs)
+    sf_api.base_url = 'https://test/services/data/v42.0/'
+    return sf_api
+
+
+class BatchLookupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sf_api = make_sf_api()
+
+    def test_resolve_emails_uses_one_in_query(self):
+        '''Known, unknown and invalid emails should be resolved with one query'''
+        records = [{'Id': 'A', 'Email': 'A@test.com'}]
+        with patch.object(SalesforceApi, 'query', return_value = {'records': records, 'done': True}) as mock_query:
+            result = self.sf_api.resolve_emails(['a@test.com', 'b@test.com', '12314'])
+            self.assertEquals(mock_query.call_count, 1)
+            soql = mock_query.call_args[0][0]
+            self.assertIn("'a@test.com'", soql)
+            self.assertIn("'b@test.com'", soql)
+            self.assertNotIn("12314", soql)
+        self.assertEquals(result, {'a@test.com': 'A', 'b@test.com': None, '12314': None})
+        self.assertEquals(self.sf_api.saved_users['b@test.com'], None)
+
+    def test_resolve_emails_skips_cached(self):
+        self.sf_api.saved_users['a@test.com'] = 'A'
+        with patch.object(SalesforceApi, 'query') as mock_query:
+            self.assertEquals(self.sf_api.resolve_emails(['a@test.com']), {'a@test.com': 'A'})
+            self.assertFalse(mock_query.called)
+
+    def test_resolve_emails_chunks_and_paginates(self):
+        '''IN lists are capped per query and nextRecordsUrl is followed'''
+        self.sf_api.QUERY_BATCH_SIZE = 2
+        first = {'records': [{'Id': '1', 'Email': 'u1@test.com'}], 'done': False, 'nextRecordsUrl': '/next'}
+        rest = {'records': [{'Id': '2', 'Email': 'u2@test.com'}], 'done': True}
+        last = {'records': [{'Id': '3', 'Email': 'u3@test.com'}], 'done': True}
+        emails = ['u%d@test.com' % i for i in range(1, 4)]
+        with patch.object(SalesforceApi, 'query', side_effect = [first, last]) as mock_query:
+            with patch.object(SalesforceApi, 'query_more', return_value = rest) as mock_more:
+                result = self.sf_api.resolve_emails(emails)
+                self.assertEquals(mock_query.call_count, 2)
+                mock_more.assert_called_with('/next', identifier_is_url=True)
+        self.assertEquals(result['u2@test.com'], '2')
+
+    def test_soql_length_limit(self):
+        self.sf_api.MAX_SOQL_LENGTH = 60
+        queries = list(self.sf_api._in_queries("SELECT Id FROM Contact WHERE Email IN (%s)",
+            ['first@test.com', 'second@test.com']))
+        self.assertEquals(len(queries), 2)
+
+    def test_soql_quote_escapes(self):
+        self.assertEquals(SalesforceApi._soql_quote("o'neil@test.com"), "'o\\'neil@test.com'")
+
+    def test_resolve_emails_uses_lookup_cache(self):
+        '''Cached verdicts should skip the Contact query and new ones should be stored'''
+        cache = Mock()
+        cache.get_many.return_value = {'a@test.com': 'A', 'b@test.com': None}
+        self.sf_api.lookup_cache = cache
+        with patch.object(SalesforceApi, 'query', return_value = {'records': [], 'done': True}) as mock_query:
+            result = self.sf_api.resolve_emails(['a@test.com', 'b@test.com', 'c@test.com'])
+            self.assertEquals(mock_query.call_count, 1)
+            self.assertNotIn("a@test.com", mock_query.call_args[0][0])
+        self.assertEquals(result, {'a@test.com': 'A', 'b@test.com': None, 'c@test.com': None})
+        cache.set_many.assert_called_with({'c@test.com': None})
+
+    def test_batch_skips_count_their_reason(self):
+        events = [{'event': 'Purchase Item', 'properties': {'time': 1426700933, 'distinct_id': email}}
+            for email in ('12314', 'b@test.com', 'b@test.com')]
+        with patch.object(SalesforceApi, 'query', return_value = {'records': [], 'done': True}):
+            self.assertEquals(self.sf_api.create_sfdc_tasks_from_mp_objects(events), [None] * 3)
+        counters = self.sf_api.stats.summary()['counters']
+        self.assertEquals(counters['skip.Not a valid email'], 1)
+        self.assertEquals(counters['skip.No user with that email'], 2)
+        self.assertNotIn('skip.Already checked and invalid', counters)
+
+
+class BulkTaskTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sf_api = make_sf_api()
+
+    def task(self, i):
+        return {'Subject': 'Subject %d' % i, 'ActivityDate': '2015-03-18', 'WhoId': 'W%d' % i}
+
+    def collection_response(self, *successes):
+        response = Mock()
+        response.json.return_value = [{'id': 'T%d' % i, 'success': True, 'errors': []} if ok
+            else {'success': False, 'errors': [{'message': 'bad'}]} for i, ok in enumerate(successes)]
+        return response
+
+    def test_flush_groups_by_collection_size(self):
+        self.sf_api.COLLECTION_SIZE = 2
+        for i in range(3):
+            self.sf_api.pending_tasks.append(self.task(i))
+        with patch.object(SalesforceApi, '_call_salesforce', side_effect = [
+                self.collection_response(True, False), self.collection_response(True)]) as mock_call:
+            results = self.sf_api.flush_tasks()
+            self.assertEquals(mock_call.call_count, 2)
+            self.assertEquals(mock_call.call_args[0][1], self.sf_api.base_url + 'composite/sobjects')
+        self.assertEquals([r['success'] for r in results], [True, False, True])
+        self.assertEquals(results[1]['errors'], [{'message': 'bad'}])
+        self.assertEquals(self.sf_api.pending_tasks, [])
+
+    def test_queue_task_flushes_when_full(self):
+        self.sf_api.COLLECTION_SIZE = 2
+        with patch.object(SalesforceApi, '_call_salesforce', return_value = self.collection_response(True, True)):
+            self.assertEquals(self.sf_api.queue_task(self.task(0)), [])
+            self.assertEquals(len(self.sf_api.queue_task(self.task(1))), 2)
+
+    def test_batch_creates_with_one_request(self):
+        '''Events in a batch should be written with a single collection request'''
+        events = [{'event': 'Purchase Item', 'properties': {'time': 1426700933 + i,
+            'distinct_id': 'u%d@test.com' % i}} for i in range(3)]
+        self.sf_api.saved_users.update({'u0@test.com': 'W0', 'u1@test.com': None, 'u2@test.com': 'W2'})
+        self.sf_api.searched_records.update({'W0': set(), 'W2': set()})
+        with patch.object(SalesforceApi, 'buffer_api'):
+            with patch.object(SalesforceApi, '_call_salesforce',
+                    return_value = self.collection_response(True, True)) as mock_call:
+                results = self.sf_api.create_sfdc_tasks_from_mp_objects(events)
+                self.assertEquals(mock_call.call_count, 1)
+        self.assertEquals(results, [True, None, True])
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now, self.slept = [0.0], []
+        self.bucket = TokenBucket(rate=10, burst=2, clock=lambda: self.now[0], sleep=self.slept.append)
+
+    def test_burst_is_free(self):
+        self.assertEquals([self.bucket.acquire(), self.bucket.acquire()], [0.0, 0.0])
+        self.assertEquals(self.slept, [])
+
+    def test_waits_past_burst_and_records_throttle(self):
+        for i in range(4):
+            self.bucket.acquire()
+        self.assertEquals(self.slept, [0.1, 0.2])
+        self.assertAlmostEquals(self.bucket.throttled, 0.3)
+
+    def test_refills_at_rate(self):
+        self.bucket.acquire(2)
+        self.now[0] = 0.1
+        self.assertEquals(self.bucket.acquire(), 0.0)
+
+    def test_only_salesforce_calls_are_charged(self):
+        '''Skipped events should not wait on the limiter'''
+        sf_api = make_sf_api(rate_limiter = self.bucket)
+        sf_api.saved_users[ValidTestCase.stub_user] = None
+        with patch.object(TokenBucket, 'acquire') as mock_acquire:
+            sf_api.create_sfdc_task_from_mp_object(ValidTestCase.mp_event_stub)
+            self.assertFalse(mock_acquire.called)
+
+
+class DedupeTestCase(unittest.TestCase):
+
+    task = {'WhoId': 'W1', 'ActivityDate': '2015-03-18', 'Subject': u'Report Preview Clicked: Trends\u2019 '}
+
+    def setUp(self):
+        self.sf_api = make_sf_api()
+
+    def test_existing_records_are_normalized(self):
+        record = {'attributes': {}, 'WhoId': u'W1', 'ActivityDate': u'2015-03-18', 'Subject': u' Report Preview Clicked: Trends'}
+        with patch.object(SalesforceApi, 'query', return_value = {'records': [record]}):
+            self.assertRaises(CustomMPDataError, self.sf_api.check_duplicate_task, self.task)
+
+    def test_created_task_is_remembered(self):
+        '''A second identical task in the same run should not be created'''
+        self.sf_api.searched_records['W1'] = set()
+        self.sf_api.Task = Mock()
+        with patch.object(SalesforceApi, 'buffer_api'):
+            self.sf_api.create_dupeless_task(dict(self.task))
+            self.assertRaises(CustomMPDataError, self.sf_api.create_dupeless_task, dict(self.task))
+        self.assertEquals(self.sf_api.Task.create.call_count, 1)
+
+    def test_failed_bulk_create_is_forgotten(self):
+        self.sf_api.searched_records['W1'] = set()
+        self.sf_api._queue_dupeless_task(dict(self.task), self.sf_api.pending_tasks)
+        response = Mock()
+        response.json.return_value = [{'success': False, 'errors': []}]
+        with patch.object(SalesforceApi, '_call_salesforce', return_value = response):
+            self.sf_api.flush_tasks()
+        self.sf_api.check_duplicate_task(dict(self.task))
+
+    def test_failed_bulk_create_error_is_forgotten(self):
+        '''A permanent error from the bulk create must not leave its tasks remembered'''
+        self.sf_api.searched_records['W1'] = set()
+        self.sf_api._queue_dupeless_task(dict(self.task), self.sf_api.pending_tasks)
+        error = SalesforceGeneralError('url', 400, 'composite', 'bad')
+        with patch.object(SalesforceApi, '_call_salesforce', side_effect = error):
+            self.assertRaises(SalesforceGeneralError, self.sf_api.flush_tasks)
+        self.sf_api.check_duplicate_task(dict(self.task))
+
+    def test_duplicate_does_not_block_contact(self):
+        '''After a duplicate, the same contact's other subjects and later batches should still be created'''
+        def event(report):
+            return {'event': 'Report Preview Clicked', 'properties': {'time': 1426700933,
+                'distinct_id': 'u@test.com', 'Report Name': report}}
+        self.sf_api.subject_components = ['Report Name']
+        self.sf_api.saved_users['u@test.com'] = 'W1'
+        self.sf_api.searched_records['W1'] = set()
+        def create(tasks):
+            return [{'task': task, 'success': True, 'retry': False} for task in tasks]
+        with patch.object(SalesforceApi, '_create_tasks', side_effect = create):
+            self.assertEquals(self.sf_api.create_sfdc_tasks_from_mp_objects([event('X'), event('X'), event('Y')]),
+                [True, None, True])
+            self.assertEquals(self.sf_api.create_sfdc_tasks_from_mp_objects([event('Z')]), [True])
+        self.assertEquals(self.sf_api.saved_users.get('u@test.com'), 'W1')
+
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sf_api = make_sf_api(activity_since = '2015-03-01')
+
+    def test_prefetch_uses_in_query_with_window(self):
+        records = [{'WhoId': 'W1', 'ActivityDate': '2015-03-18', 'Subject': 'Done'}]
+        with patch.object(SalesforceApi, 'query', return_value = {'records': records, 'done': True}) as mock_query:
+            self.sf_api.prefetch_activity_records(['W1', 'W2', None])
+            self.assertEquals(mock_query.call_count, 1)
+            soql = mock_query.call_args[0][0]
+        self.assertIn("WhoId IN (", soql)
+        self.assertIn("AND ActivityDate >= 2015-02-28", soql)
+        self.assertEquals(self.sf_api.searched_records['W1'], set([SalesforceApi._task_key(records[0])]))
+        self.assertEquals(self.sf_api.searched_records['W2'], set())
+
+    def test_prefetch_skips_searched(self):
+        self.sf_api.searched_records['W1'] = set()
+        with patch.object(SalesforceApi, 'query') as mock_query:
+            self.sf_api.prefetch_activity_records(['W1'])
+            self.assertFalse(mock_query.called)
+
+    def test_single_lookup_uses_window(self):
+        with patch.object(SalesforceApi, 'query', return_value = {'records': []}) as mock_query:
+            self.sf_api._save_activity_records('W1')
+            self.assertIn("AND ActivityDate >= 2015-02-28", mock_query.call_args[0][0])
+
+    def test_window_covers_events_dated_before_from_date(self):
+        '''An event exported for from_date may have a local date a day earlier; its Task must still be found'''
+        event_time = time.mktime((2015, 2, 28, 23, 0, 0, 0, 0, -1))
+        event = {'event': 'Purchase Item', 'properties': {'time': event_time, 'distinct_id': 'u@test.com'}}
+        record = {'WhoId': 'W1', 'ActivityDate': '2015-02-28', 'Subject': 'Purchase Item:'}
+        def query(soql):
+            since = soql.rsplit('>= ', 1)[-1] if 'Task' in soql else ''
+            return {'records': [record] if since <= record['ActivityDate'] else [], 'done': True}
+        self.sf_api.saved_users['u@test.com'] = 'W1'
+        with patch.object(SalesforceApi, 'query', side_effect = query):
+            with patch.object(SalesforceApi, '_call_salesforce') as mock_call:
+                self.assertEquals(self.sf_api.create_sfdc_tasks_from_mp_objects([event]), [None])
+                self.assertFalse(mock_call.called)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sf_api = make_sf_api()
+
+    def test_skip_reasons_are_counted(self):
+        with patch.object(SalesforceApi, 'query', return_value = {'records': []}):
+            self.sf_api.create_sfdc_task_from_mp_object({'event': 'E', 'properties': {'time': 1, 'distinct_id': '123'}})
+            self.sf_api.create_sfdc_task_from_mp_object({'event': 'E'})
+        counters = self.sf_api.stats.summary()['counters']
+        self.assertEquals(counters['skip.Not a valid email'], 1)
+        self.assertEquals(counters['skip.bad event'], 1)
+
+    def test_duplicates_counted_under_one_reason(self):
+        self.sf_api.searched_records['W1'] = set([SalesforceApi._task_key({'ActivityDate': '2015-03-18', 'Subject': 'S'})])
+        with patch.object(SalesforceApi, 'event_to_salesforce_task_object',
+                return_value = {'WhoId': 'W1', 'ActivityDate': '2015-03-18', 'Subject': 'S'}):
+            self.sf_api.create_sfdc_task_from_mp_object(ValidTestCase.mp_event_stub)
+        self.assertEquals(self.sf_api.stats.summary()['counters']['skip.duplicate task'], 1)
+
+    def test_query_stage_names(self):
+        self.assertEquals(SalesforceApi._query_stage("SELECT Id FROM Contact WHERE Email IN ('a')"), 'api.query.contact')
+        self.assertEquals(SalesforceApi._query_stage("SELECT Id from User where Name='x'"), 'api.query.user')
+
+
+class CoalesceTestCase(unittest.TestCase):
+
+    day = 1426700933
+
+    def setUp(self):
+        self.sf_api = make_sf_api()
+        self.sf_api.subject_components = ['Report Name']
+
+    def event(self, t, user = 'a@test.com', report = 'Trends'):
+        return {'event': 'Report Preview Clicked', 'properties': {'time': t, 'distinct_id': user, 'Report Name': report}}
+
+    def test_identical_events_are_coalesced(self):
+        events = [self.event(self.day), self.event(self.day + 60), self.event(self.day + 61, report = 'Other'),
+                  self.event(self.day + 62, user = 'b@test.com'), self.event(self.day + 120)]
+        coalesced = list(self.sf_api.coalesce_events(iter(events)))
+        self.assertEquals(coalesced, [events[0], events[2], events[3]])
+        self.assertEquals(self.sf_api.stats.summary()['counters']['coalesced'], 2)
+
+    def test_aggregate_counts_in_properties(self):
+        events = [self.event(self.day), self.event(self.day + 60), self.event(self.day + 90)]
+        coalesced = list(self.sf_api.coalesce_events(iter(events), aggregate = True))
+        properties = coalesced[0]['properties']
+        self.assertEquals((properties['coalesced_count'], properties['first_time'], properties['last_time']),
+            (3, self.day, self.day + 90))
+        self.assertNotIn('coalesced_count', events[0]['properties'])
+
+    def test_groups_released_when_day_changes(self):
+        '''Earlier days should be emitted before the rest of the input is read'''
+        def events():
+            yield self.event(self.day)
+            yield self.event(self.day + 86400 * 2)
+            raise AssertionError('read too far')
+        coalesced = self.sf_api.coalesce_events(events())
+        self.assertEquals(next(coalesced), self.event(self.day))
+
+    def test_bad_events_pass_through(self):
+        bad = {'event': 'Report Preview Clicked'}
+        self.assertEquals(list(self.sf_api.coalesce_events(iter([bad]))), [bad])
+
+
+class BoundedCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sf_api = make_sf_api(saved_users_size = 2, searched_records_size = 2)
+
+    def test_saved_users_evicts_least_recent(self):
+        self.sf_api.saved_users.update({'a@test.com': 'A', 'b@test.com': 'B'})
+        self.assertEquals(self.sf_api.check_email_and_get_id('a@test.com'), 'A')
+        self.sf_api.saved_users['c@test.com'] = None
+        self.assertNotIn('b@test.com', self.sf_api.saved_users)
+        self.assertIn('a@test.com', self.sf_api.saved_users)
+        self.assertEquals(self.sf_api.stats.summary()['counters']['cache.saved_users.evicted'], 1)
+        self.assertEquals(self.sf_api.saved_users.info()['evictions'], 1)
+
+    def test_resolve_more_emails_than_cache_holds(self):
+        records = [{'Id': 'C%d' % i, 'Email': 'u%d@test.com' % i} for i in range(5)]
+        with patch.object(SalesforceApi, 'query', return_value = {'records': records, 'done': True}):
+            resolved = self.sf_api.resolve_emails([r['Email'] for r in records])
+        self.assertEquals(resolved, dict((r['Email'], r['Id']) for r in records))
+        self.assertEquals(len(self.sf_api.saved_users), 2)
+
+    def test_evicted_tasks_are_reloaded(self):
+        task = {'WhoId': 'W0', 'ActivityDate': '2015-03-18', 'Subject': 'S'}
+        self.sf_api._remember_task(task)
+        for user_id in 'W1', 'W2':
+            self.sf_api.searched_records[user_id] = set()
+        with patch.object(SalesforceApi, 'query', return_value = {'records': [task], 'done': True}) as mock_query:
+            self.assertRaises(CustomMPDataError, self.sf_api.check_duplicate_task, task)
+            self.assertEquals(mock_query.call_count, 1)
+
+    def test_forget_invalid_users(self):
+        self.sf_api.saved_users.update({'a@test.com': 'A', 'b@test.com': None})
+        self.sf_api.forget_invalid_users()
+        self.assertEquals(self.sf_api.saved_users.get('a@test.com'), 'A')
+        self.assertNotIn('b@test.com', self.sf_api.saved_users)
+        self.assertEquals(self.sf_api.stats.summary()['counters']['cache.saved_users.expired'], 1)
+
+    def test_task_fingerprint_is_compact(self):
+        key = SalesforceApi._task_key({'WhoId': 'W0', 'ActivityDate': '2015-03-18', 'Subject': u'Caf\xe9 Report '})
+        self.assertIsInstance(key, int)
+        self.assertEquals(key, SalesforceApi._task_key({'ActivityDate': '2015-03-18', 'Subject': 'Caf Report'}))
+
+
+class AdaptiveRateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.bucket = TokenBucket(rate=10, burst=10, clock=lambda: self.now[0], sleep=lambda s: None)
+        self.control = AdaptiveRate(self.bucket, min_rate=2, max_rate=12, max_in_flight=8, cooldown=1.0,
+            clock=lambda: self.now[0])
+
+    def test_additive_increase_up_to_max(self):
+        self.control.on_success()
+        self.assertAlmostEquals(self.bucket.rate, 10.1)
+        for i in range(1000):
+            self.control.on_success()
+        self.assertEquals(self.bucket.rate, 12)
+        self.assertEquals(self.control.in_flight_limit, 8)
+
+    def test_multiplicative_decrease_once_per_cooldown(self):
+        self.assertTrue(self.control.on_throttle())
+        self.assertFalse(self.control.on_throttle())
+        self.assertEquals((self.bucket.rate, self.control.in_flight_limit), (5, 4))
+        self.now[0] = 1.5
+        self.control.on_throttle()
+        self.control.on_throttle()
+        self.now[0] = 3
+        self.control.on_throttle()
+        self.assertEquals((self.bucket.rate, self.control.in_flight_limit), (2, 1))
+
+    def test_usage_near_limit_backs_off(self):
+        self.assertFalse(self.control.on_usage(100, 1000))
+        self.assertTrue(self.control.on_usage(950, 1000))
+
+
+class RetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sf_api = make_sf_api(max_retries = 2)
+        self.sleep = patch('src.salesforce_mp_zap.time.sleep').start()
+        self.addCleanup(patch.stopall)
+
+    def error(self, status, content = 'oops'):
+        return SalesforceGeneralError('url', status, 'query', content)
+
+    def test_transient_query_errors_are_retried(self):
+        with patch.object(Salesforce, 'query', side_effect = [self.error(503), self.error(500), {'records': []}]) as mock_query:
+            self.assertEquals(self.sf_api.query('SELECT Id FROM Contact'), {'records': []})
+            self.assertEquals(mock_query.call_count, 3)
+        self.assertEquals(self.sleep.call_count, 2)
+        self.assertLessEqual(self.sleep.call_args_list[1][0][0], self.sf_api.backoff_base * 2)
+        counters = self.sf_api.stats.summary()['counters']
+        self.assertEquals((counters['api.retries'], counters['api.throttled']), (2, 1))
+
+    def test_limit_errors_slow_down(self):
+        limited = SalesforceRefusedRequest('url', 403, 'query', [{'errorCode': 'REQUEST_LIMIT_EXCEEDED'}])
+        with patch.object(Salesforce, 'query', side_effect = [limited, {'records': []}]):
+            self.sf_api.query('SELECT Id FROM Contact')
+        self.assertLess(self.sf_api.rate_limiter.rate, 20)
+
+    def test_gives_up_after_max_retries(self):
+        with patch.object(Salesforce, 'query', side_effect = self.error(503)) as mock_query:
+            self.assertRaises(SalesforceGeneralError, self.sf_api.query, 'SELECT Id FROM Contact')
+            self.assertEquals(mock_query.call_count, 3)
+
+    def test_permanent_errors_are_not_retried(self):
+        with patch.object(Salesforce, 'query', side_effect = SalesforceMalformedRequest('url', 400, 'query', 'bad')) as mock_query:
+            self.assertRaises(SalesforceMalformedRequest, self.sf_api.query, 'SELECT')
+            self.assertEquals(mock_query.call_count, 1)
+
+    def test_posts_only_retried_when_nothing_was_done(self):
+        with patch.object(Salesforce, '_call_salesforce', side_effect = self.error(500)) as mock_call:
+            self.assertRaises(SalesforceGeneralError, self.sf_api._call_salesforce, 'POST', 'url/composite/sobjects')
+            self.assertEquals(mock_call.call_count, 1)
+
+    def test_failed_batch_goes_to_retry_queue(self):
+        events = [{'event': 'Purchase Item', 'properties': {'time': 1426700933, 'distinct_id': 'u%d@test.com' % i}}
+            for i in range(2)]
+        self.sf_api.saved_users.update({'u0@test.com': 'W0', 'u1@test.com': 'W1'})
+        self.sf_api.searched_records.update({'W0': set(), 'W1': set()})
+        with patch.object(Salesforce, '_call_salesforce', side_effect = self.error(503)):
+            self.assertEquals(self.sf_api.create_sfdc_tasks_from_mp_objects(events), [None, None])
+        self.assertEquals(self.sf_api.drain_retry_queue(), events)
+        self.assertEquals(self.sf_api.retry_queue, [])
+        #Forgotten, so the replay is not taken for a duplicate
+        self.assertEquals(self.sf_api.searched_records['W0'], set())
+
+    def uncertain_errors(self):
+        return [requests.exceptions.ReadTimeout('timed out'), self.error(500)]
+
+    def test_uncertain_bulk_create_queries_tasks_again(self):
+        '''After a timeout or 500 the Tasks may exist, so the replay must find them rather than create them twice'''
+        event = {'event': 'Purchase Item', 'properties': {'time': 1426700933, 'distinct_id': 'u0@test.com'}}
+        record = {'WhoId': 'W0', 'Subject': 'Purchase Item:',
+                  'ActivityDate': SalesforceApi.convert_time_stamp_to_sf_date_format(1426700933)}
+        for error in self.uncertain_errors():
+            self.sf_api.saved_users['u0@test.com'] = 'W0'
+            self.sf_api.searched_records['W0'] = set()
+            with patch.object(Salesforce, '_call_salesforce', side_effect = error) as mock_call:
+                self.assertEquals(self.sf_api.create_sfdc_tasks_from_mp_objects([event]), [None])
+                self.assertEquals(mock_call.call_count, 1)
+            self.assertNotIn('W0', self.sf_api.searched_records)
+            self.assertEquals(self.sf_api.drain_retry_queue(), [event])
+            with patch.object(SalesforceApi, 'query', return_value = {'records': [record], 'done': True}):
+                with patch.object(Salesforce, '_call_salesforce') as mock_call:
+                    self.assertEquals(self.sf_api.create_sfdc_tasks_from_mp_objects([event]), [None])
+                    self.assertFalse(mock_call.called)
+
+    def test_uncertain_single_create_queries_tasks_again(self):
+        event = {'event': 'Purchase Item', 'properties': {'time': 1426700933, 'distinct_id': 'u0@test.com'}}
+        for error in self.uncertain_errors():
+            self.sf_api.saved_users['u0@test.com'] = 'W0'
+            self.sf_api.searched_records['W0'] = set()
+            self.sf_api.Task = Mock()
+            self.sf_api.Task.create.side_effect = error
+            self.sf_api.create_sfdc_task_from_mp_object(event)
+            self.assertEquals(self.sf_api.Task.create.call_count, 1)
+            self.assertNotIn('W0', self.sf_api.searched_records)
+            self.assertEquals(self.sf_api.drain_retry_queue(), [event])
+
+    def test_refused_single_create_keeps_tasks(self):
+        '''A 503 proves nothing was written, so the contact's Tasks need not be queried again'''
+        event = {'event': 'Purchase Item', 'properties': {'time': 1426700933, 'distinct_id': 'u0@test.com'}}
+        self.sf_api.saved_users['u0@test.com'] = 'W0'
+        self.sf_api.searched_records['W0'] = set()
+        self.sf_api.Task = Mock()
+        self.sf_api.Task.create.side_effect = self.error(503)
+        self.sf_api.create_sfdc_task_from_mp_object(event)
+        self.assertEquals(self.sf_api.searched_records['W0'], set())
+        self.assertEquals(self.sf_api.drain_retry_queue(), [event])
+
+    def test_expired_session_logs_in_again(self):
+        self.sf_api.session_id = 'old'
+        def login(**kwargs):
+            self.sf_api.session_id = 'new'
+        expired = SalesforceExpiredSession('url', 401, 'query', 'expired')
+        with patch.object(SalesforceApi, '_login', side_effect = login) as mock_login:
+            with patch.object(Salesforce, 'query', side_effect = [expired, {'records': []}]):
+                self.assertEquals(self.sf_api.query('SELECT Id FROM Contact'), {'records': []})
+            self.assertEquals(mock_login.call_args[1]['assigned_to'], 'Owner')
+            #Another thread already replaced the expired session
+            self.sf_api.relogin('old')
+            self.assertEquals(mock_login.call_count, 1)
+
+    def test_limit_info_header_is_read(self):
+        response = Mock(headers = {'Sforce-Limit-Info': 'api-usage=4900/5000'})
+        self.sf_api._read_limit_info(response)
+        self.assertEquals(self.sf_api.api_usage, (4900, 5000))
+        self.assertEquals(self.sf_api.rate_limiter.rate, 10)
+
+
+class LazyLoginTestCase(unittest.TestCase):
+
+    def setUp(self):
+        def login(sf_api, **kwargs):
+            sf_api.session_id, sf_api.base_url = 'session', 'https://test/services/data/v42.0/'
+        self.login = patch.object(Salesforce, '__init__', autospec = True, side_effect = login).start()
+        self.addCleanup(patch.stopall)
+        self.sf_api = SalesforceApi(subject_components = [], task_status = 'Completed',
+            assigned_to = 'Owner', lazy_login = True)
+
+    def test_nothing_happens_until_needed(self):
+        self.assertFalse(self.login.called)
+        self.assertEquals(list(self.sf_api.coalesce_events(iter([]))), [])
+        self.assertFalse(self.login.called)
+
+    def test_first_call_logs_in_once(self):
+        with patch.object(Salesforce, 'query', return_value = {'records': []}):
+            self.sf_api.query('SELECT Id FROM Contact')
+            self.sf_api.query('SELECT Id FROM Contact')
+        self.assertEquals(self.login.call_count, 1)
+        self.assertNotIn('lazy_login', self.login.call_args[1])
+
+    def test_session_attributes_log_in(self):
+        self.assertEquals(self.sf_api.base_url, 'https://test/services/data/v42.0/')
+        self.assertEquals(self.login.call_count, 1)
+
+    def test_shared_adapter_is_mounted(self):
+        adapter = Mock()
+        def login(sf_api, **kwargs):
+            sf_api.request = Mock(hooks = {'response': []})
+        self.login.side_effect = login
+        sf_api = SalesforceApi(subject_components = [], task_status = 'Completed',
+            assigned_to = 'Owner', lazy_login = True, http_adapter = adapter)
+        sf_api._ensure_login()
+        sf_api.request.mount.assert_called_with('https://', adapter)
+
+    def test_owner_looked_up_on_first_use(self):
+        with patch.object(SalesforceApi, 'get_ownerid_from_assigned_to_name', return_value = 'Owner Id') as mock_owner:
+            self.assertFalse(mock_owner.called)
+            self.assertEquals((self.sf_api.owner_id, self.sf_api.owner_id), ('Owner Id', 'Owner Id'))
+            self.assertEquals(mock_owner.call_count, 1)
+            mock_owner.assert_called_with('Owner')
+
+
+class OwnerRoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        #Owners are then loaded by the first task, through the patched queries below
+        with patch.object(SalesforceApi, '_lookup_owner_id', return_value = None):
+            self.sf_api = make_sf_api(router = OwnerRouter([
+                {'property': 'mp_country_code', 'values': ['DE'], 'owner': 'Hans'},
+                {'event': 'Refund', 'contact_owner': True},
+            ]))
+
+    def event(self, i, name = 'Purchase Item', country = 'US'):
+        return {'event': name, 'properties': {'time': 1426700933, 'distinct_id': 'u%d@test.com' % i,
+            'mp_country_code': country}}
+
+    def fake_query(self, soql):
+        if 'FROM User' in soql:
+            return {'records': [{'Id': 'U1', 'Name': 'owner'}, {'Id': 'U2', 'Name': 'Hans'}], 'done': True}
+        if 'FROM Contact' in soql:
+            return {'records': [{'Id': 'C%d' % i, 'Email': 'u%d@test.com' % i, 'OwnerId': 'CO%d' % i}
+                for i in range(3)], 'done': True}
+        return {'records': [], 'done': True}
+
+    def test_batch_routes_without_per_event_queries(self):
+        events = [self.event(0), self.event(1, country = 'DE'), self.event(2, name = 'Refund')]
+        with patch.object(SalesforceApi, 'query', side_effect = self.fake_query) as mock_query:
+            with patch.object(SalesforceApi, '_create_tasks', side_effect = lambda tasks: [
+                    {'success': True, 'retry': False} for task in tasks]) as mock_create:
+                self.sf_api.create_sfdc_tasks_from_mp_objects(events)
+            #One query each for Contacts, Tasks and Users
+            self.assertEquals(mock_query.call_count, 3)
+            self.assertIn('OwnerId FROM Contact', mock_query.call_args_list[0][0][0])
+        owners = [task['OwnerId'] for task in mock_create.call_args[0][0]]
+        self.assertEquals(owners, ['U1', 'U2', 'CO2'])
+
+    def test_cached_contacts_owners_loaded_in_bulk(self):
+        self.sf_api.saved_users.update({'u0@test.com': 'C0', 'u1@test.com': 'C1'})
+        with patch.object(SalesforceApi, 'query', side_effect = self.fake_query) as mock_query:
+            self.sf_api.resolve_emails(['u0@test.com', 'u1@test.com'])
+            self.assertEquals(mock_query.call_count, 1)
+            self.assertIn('Id IN (', mock_query.call_args[0][0])
+        self.assertEquals(self.sf_api.contact_owners.get('C1'), 'CO1')
+
+    def test_unknown_owner_falls_back_to_assignee(self):
+        self.sf_api.router = OwnerRouter([{'owner': 'Nobody'}])
+        with patch.object(SalesforceApi, 'query', side_effect = self.fake_query):
+            self.assertEquals(self.sf_api.route_owner('Refund', {}, 'C0'), 'U1')
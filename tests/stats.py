@@ -0,0 +1,49 @@
+import sys
+sys.path.append('..')
+
+from src.stats import RunStats
+from src.mixpanel_api import Mixpanel
+
+import unittest
+import json
+import os
+import tempfile
+
+
+class RunStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.stats = RunStats(clock = lambda: self.now[0])
+
+    def test_timed_stage(self):
+        with self.stats.timed('api.query.contact'):
+            self.now[0] += 1.5
+        with self.stats.timed('api.query.contact'):
+            self.now[0] += 0.5
+        self.assertEquals(self.stats.summary()['stages']['api.query.contact'], {'seconds': 2.0, 'calls': 2})
+
+    def test_summary_is_json(self):
+        self.stats.incr('skip.Not a valid email')
+        self.stats.incr('skip.Not a valid email')
+        summary = json.loads(json.dumps(self.stats.summary()))
+        self.assertEquals(summary['counters'], {'skip.Not a valid email': 2})
+        self.assertIn('peak_rss_kb', summary)
+
+    def test_write_json_with_extra_keys(self):
+        self.stats.incr('tasks.created')
+        path = tempfile.mktemp()
+        self.addCleanup(os.remove, path)
+        self.stats.write_json(path, tenants = {'acme': {}})
+        with open(path) as f:
+            summary = json.load(f)
+        self.assertEquals(summary['counters'], {'tasks.created': 1})
+        self.assertEquals(summary['tenants'], {'acme': {}})
+
+    def test_mixpanel_parse_counters(self):
+        mixpanel = Mixpanel(api_key = 'key', api_secret = 'secret', stats = self.stats)
+        mixpanel.data = '{"event":"A","properties":{}}\n{"event":"B","properties":{}}\n'
+        list(mixpanel.iter_events(['A']))
+        summary = self.stats.summary()
+        self.assertEquals(summary['stages']['export.parse']['calls'], 1)
+        self.assertEquals(summary['counters']['export.prefiltered'], 1)
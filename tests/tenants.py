@@ -0,0 +1,85 @@
+import sys
+sys.path.append('..')
+
+from src.tenants import load_tenants, Tenant, FairScheduler
+from src.stats import RunStats
+
+import unittest
+import json
+import os
+import tempfile
+
+
+class FakeSalesforceApi(object):
+
+    def __init__(self, order, fail = False):
+        self.order, self.fail = order, fail
+
+    def create_sfdc_tasks_from_mp_objects(self, events):
+        if self.fail:
+            raise ValueError('bad credentials')
+        self.order.append(events[0]['tenant'])
+        return [True] * len(events)
+
+
+def tenant(name, n, order, fail = False):
+    events = [{'tenant': name, 'i': i} for i in range(n)]
+    return Tenant(name, FakeSalesforceApi(order, fail), events, RunStats())
+
+
+class FairSchedulerTestCase(unittest.TestCase):
+
+    def test_tenants_take_turns(self):
+        '''A big tenant should not hold the only worker until it is done'''
+        order = []
+        tenants = [tenant('big', 10, order), tenant('small', 2, order)]
+        list(FairScheduler(tenants, workers = 1, batch_size = 2).run())
+        self.assertEquals(order[:3], ['big', 'small', 'big'])
+        self.assertEquals(len(order), 6)
+
+    def test_batches_keep_tenant_order(self):
+        order = []
+        tenants = [tenant('a', 7, order), tenant('b', 5, order), tenant('c', 3, order)]
+        seen = {}
+        for t, batch, results in FairScheduler(tenants, workers = 3, batch_size = 2).run():
+            seen.setdefault(t.name, []).extend(event['i'] for event in batch)
+            self.assertEquals(results, [True] * len(batch))
+        self.assertEquals(seen, {'a': range(7), 'b': range(5), 'c': range(3)})
+
+    def test_failing_tenant_is_dropped(self):
+        order = []
+        tenants = [tenant('ok', 4, order), tenant('broken', 4, order, fail = True)]
+        batches = list(FairScheduler(tenants, workers = 2, batch_size = 2).run())
+        self.assertEquals([t.name for t, batch, results in batches], ['ok', 'ok'])
+        self.assertIsInstance(tenants[1].error, ValueError)
+        self.assertEquals(tenants[1].stats.summary()['counters'], {'tenant.failed': 1})
+
+
+class LoadTenantsTestCase(unittest.TestCase):
+
+    entry = {'name': 'acme', 'mp_api_key': 'k', 'mp_api_secret': 's', 'username': 'u', 'password': 'p',
+             'security_token': 't', 'events': ['Report'], 'subject_components': [], 'assigned_to': 'Bob'}
+
+    def write(self, tenants):
+        fd, path = tempfile.mkstemp(suffix = '.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'tenants': tenants}, f)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_defaults_are_filled(self):
+        tenants = load_tenants(self.write([dict(self.entry, api_rate = 5)]))
+        self.assertEquals((tenants[0]['api_rate'], tenants[0]['api_burst'], tenants[0]['sandbox']), (5, 20, False))
+
+    def test_max_rate_defaults_to_rate(self):
+        tenants = load_tenants(self.write([dict(self.entry, name = 'a', api_rate = 5),
+                                           dict(self.entry, name = 'b', api_rate = 5, api_max_rate = 8)]))
+        self.assertEquals([tenant['api_max_rate'] for tenant in tenants], [5, 8])
+
+    def test_missing_keys_are_reported(self):
+        entry = dict(self.entry)
+        del entry['password']
+        self.assertRaisesRegexp(ValueError, 'acme .* password', load_tenants, self.write([entry]))
+
+    def test_duplicate_names_rejected(self):
+        self.assertRaises(ValueError, load_tenants, self.write([self.entry, self.entry]))